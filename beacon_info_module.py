@@ -3,33 +3,479 @@
 #
 # Derived from work by Papers GmbH (AirGap):
 # https://github.com/airgap-it/beacon-node
+#
+# Register in homeserver.yaml:
+#   modules:
+#     - module: beacon_info_module.BeaconInfoModule
+#       config:
+#         known_servers:
+#           - beacon-node-1.diamond.papers.tech
+#         cache_granularity_seconds: 0   # >0: round timestamp, cache body, send ETag
+#         probe_interval_seconds: 0      # >0: probe known_servers and rank them
+#         probe_path: /_matrix/federation/v1/version
+#         probe_timeout_seconds: 5
+#         probe_concurrency: 4
+#         probe_jitter_seconds: 5
+#         probe_on_all_instances: false  # true: also probe on workers serving /info
+#         network_cache_seconds: 30      # /beacon/network: serve the aggregate this long
+#         network_stale_seconds: 300     # then serve it stale while refreshing
+#         network_concurrency: 16
+#         load_interval_seconds: 15      # how often the "load" summary is refreshed, 0 = off
+#         load_lag_metrics:              # gauges whose max is reported as event_lag_ms
+#           - synapse_event_processing_lag
 
 import json
 import logging
+import math
 import os
+import random
 import time
+import zlib
 from typing import Any
 
+from prometheus_client import REGISTRY
+from synapse.logging.context import (
+    PreserveLoggingContext,
+    make_deferred_yieldable,
+    run_in_background,
+)
+from synapse.util.async_helpers import concurrently_execute
+from twisted.internet import defer, reactor
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 
 logger = logging.getLogger(__name__)
 
+# Metrics read by _LoadSampler
+_IN_FLIGHT_METRIC = "synapse_http_server_in_flight_requests_count"
+_SYNC_SERVLET = "SyncRestServlet"
+_AUTH_ATTEMPTS_METRIC = "beacon_auth_attempts_total"
+
+_NETWORK_UNAVAILABLE = b'{"errcode": "M_UNKNOWN", "error": "Network view unavailable"}'
+
+# Login time window length. Must match crypto_auth_provider.WINDOW_SECONDS;
+# duplicated so this module deploys without the auth provider.
+WINDOW_SECONDS = 5 * 60
+
+
+def _server_url(server: str, path: str) -> str:
+    """URL of path on a known server. Entries with a scheme (e.g.
+    http://127.0.0.1:8008) are used as the base as-is, others get https."""
+    base = server if "://" in server else "https://" + server
+    return base.rstrip("/") + path
+
+
+def _fetch_json(http_client, url: str, timeout: float) -> defer.Deferred:
+    """GET url and parse the JSON body.
+
+    http_client is the module API's (SimpleHttpClient), so requests go out
+    with the homeserver's proxy, TLS and User-Agent settings. Fires with
+    (rtt_seconds, body), where the RTT covers the full response, or fails
+    on a non-2xx status, invalid JSON or timeout. Never raises.
+
+    The request runs via run_in_background, so the returned Deferred does
+    not follow the logcontext rules: await it with make_deferred_yieldable.
+    """
+    start = time.monotonic()
+    d = run_in_background(http_client.get_json, url)
+    d.addCallback(lambda body: (time.monotonic() - start, body))
+    d.addTimeout(timeout, reactor, onTimeoutCancel=_timed_out)
+    return d
+
+
+def _timed_out(_result, timeout: float):
+    # Replaces the client's cancellation failure with a readable one
+    raise TimeoutError("no response within {}s".format(timeout))
+
+
+class _ServerHealth:
+    """Result of the latest probe of one known server."""
+
+    __slots__ = ("server", "order", "available", "rtt_ms", "last_probe", "error")
+
+    def __init__(self, server: str, order: int):
+        self.server = server
+        self.order = order
+        # None until the first probe completes
+        self.available: bool | None = None
+        self.rtt_ms: float | None = None
+        self.last_probe: float | None = None
+        self.error: str | None = None
+
+    def rank(self) -> tuple:
+        """Sort key: reachable servers by RTT, then unprobed, then down."""
+        if self.available:
+            return (0, self.rtt_ms, self.order)
+        return (1 if self.available is None else 2, 0.0, self.order)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "server": self.server,
+            "available": self.available,
+            "rtt_ms": self.rtt_ms,
+            "last_probe": self.last_probe,
+        }
+
+
+class _ServerProber:
+    """Probes each known server and ranks them.
+
+    probe_all runs one round with at most concurrency requests in flight
+    and follows the logcontext rules, so it can be driven by
+    looping_background_call. Results are kept until the next round and
+    handed to on_update as a ranked list.
+    """
+
+    def __init__(
+        self,
+        http_client,
+        servers: list[str],
+        path: str,
+        timeout: float,
+        concurrency: int,
+        on_update,
+    ):
+        self._health = [_ServerHealth(server, i) for i, server in enumerate(servers)]
+        self._path = path
+        self._timeout = timeout
+        self._concurrency = max(1, concurrency)
+        self._on_update = on_update
+        self._http_client = http_client
+
+    def ranked(self) -> list[_ServerHealth]:
+        return sorted(self._health, key=_ServerHealth.rank)
+
+    async def _probe(self, health: _ServerHealth) -> None:
+        try:
+            rtt, _body = await make_deferred_yieldable(_fetch_json(
+                self._http_client, _server_url(health.server, self._path),
+                self._timeout))
+        except Exception as e:
+            if health.available is not False:
+                logger.warning(
+                    "event=PROBE_FAILED server=%s error=%s", health.server, e)
+            health.available = False
+            health.rtt_ms = None
+            health.error = str(e)
+        else:
+            if health.available is False:
+                logger.info("event=PROBE_RECOVERED server=%s", health.server)
+            health.available = True
+            health.rtt_ms = round(rtt * 1000, 1)
+            health.error = None
+        health.last_probe = time.time()
+
+    async def probe_all(self) -> None:
+        """Run one round; returns once on_update has the new ranking."""
+        await concurrently_execute(self._probe, self._health, self._concurrency)
+        ranked = self.ranked()
+        logger.info(
+            "event=PROBE_ROUND available=%d total=%d",
+            sum(1 for h in ranked if h.available), len(ranked))
+        self._on_update(ranked)
+
+
+class _LoadSampler:
+    """Summarises this process's load from its own Prometheus metrics.
+
+    Meant to run at a fixed interval: rates (logins, CPU) are deltas since
+    the previous sample, and reading only the named metrics keeps each
+    sample cheap. Fields whose metric is not registered in this process
+    are null.
+    """
+
+    def __init__(self, lag_metrics: list[str], on_update):
+        self._lag_metrics = frozenset(lag_metrics)
+        self._registry = REGISTRY.restricted_registry(
+            [_IN_FLIGHT_METRIC, _AUTH_ATTEMPTS_METRIC, *lag_metrics])
+        self._on_update = on_update
+        self._last_wall = time.monotonic()
+        self._last_cpu = time.process_time()
+        self._last_logins: float | None = None
+
+    def sample(self) -> None:
+        sync_requests = 0
+        event_lag = None
+        logins = None
+        for metric in self._registry.collect():
+            for sample in metric.samples:
+                if sample.name == _IN_FLIGHT_METRIC:
+                    if sample.labels.get("servlet") == _SYNC_SERVLET:
+                        sync_requests += int(sample.value)
+                elif sample.name == _AUTH_ATTEMPTS_METRIC:
+                    # Registered even if nothing succeeded yet; failed
+                    # attempts (scanners, bad signatures) are not load
+                    logins = logins or 0
+                    if sample.labels.get("outcome") == "ok":
+                        logins += sample.value
+                elif sample.name in self._lag_metrics:
+                    event_lag = max(event_lag or 0, sample.value)
+
+        wall = time.monotonic()
+        cpu = time.process_time()
+        elapsed = wall - self._last_wall
+        login_rate = None
+        if logins is not None and self._last_logins is not None and elapsed > 0:
+            login_rate = round((logins - self._last_logins) / elapsed, 3)
+        self._on_update({
+            "sync_requests": sync_requests,
+            "event_lag_ms": event_lag,
+            "login_rate": login_rate,
+            # Fraction of one core used by this process since the last sample
+            "cpu": round((cpu - self._last_cpu) / elapsed, 3) if elapsed > 0 else None,
+        })
+        self._last_wall = wall
+        self._last_cpu = cpu
+        self._last_logins = logins
+
+
+def _opaque_tag(tag: bytes) -> bytes:
+    """An entity tag without its W/ prefix. If-None-Match uses the weak
+    comparison (RFC 9110 13.1.2), and CDNs weaken ETags when they compress."""
+    tag = tag.strip()
+    return tag[2:] if tag.startswith(b"W/") else tag
+
 
 class BeaconInfoResource(Resource):
+    """Serves region, known_servers and the current timestamp.
+
+    Everything but the timestamp only changes when the prober reports, so
+    the JSON is encoded then and each response splices the timestamp into
+    it. With a
+    granularity, the timestamp is rounded down to it and the whole body is
+    reused (with an ETag and max-age) until the next step.
+    """
+
     isLeaf = True
 
     def __init__(self, config: dict[str, Any]):
         super().__init__()
         self.config = config
+        self._granularity = float(config.get("cache_granularity_seconds", 0))
+        self._static: dict[str, Any] = {
+            "region": os.environ.get("SERVER_REGION", "region not set"),
+            "known_servers": config.get("known_servers", []),
+        }
+        if self._granularity > 0:
+            # Lets readers (e.g. /beacon/network) correct for the rounding
+            self._static["timestamp_granularity"] = self._granularity
+        self._encode()
+
+    def _encode(self) -> None:
+        static = json.dumps(self._static).encode("utf-8")
+        # '{..., "known_servers": [...]' + ', "timestamp": ' + ts + '}'
+        self._prefix = static[:-1] + b', "timestamp": '
+        self._static_tag = zlib.crc32(static)
+        self._cached_step = None
+        self._cached_body = b""
+        self._cached_etag = b""
+
+    def set_servers(self, ranked: list[_ServerHealth]) -> None:
+        """Order known_servers by probe results and include the details."""
+        self._static["known_servers"] = [health.server for health in ranked]
+        self._static["servers"] = [health.as_dict() for health in ranked]
+        self._encode()
+
+    def set_load(self, summary: dict[str, Any]) -> None:
+        self._static["load"] = summary
+        self._encode()
+
+    def _body(self, timestamp: float) -> bytes:
+        return self._prefix + repr(timestamp).encode("ascii") + b"}"
 
     def render_GET(self, request):
         request.setHeader(b"content-type", b"application/json; charset=utf-8")
         request.setHeader(b"Access-Control-Allow-Origin", b"*")
-        return json.dumps({
-            "region": os.environ.get("SERVER_REGION", "region not set"),
-            "known_servers": self.config.get("known_servers", []),
+        now = time.time()
+        if self._granularity <= 0:
+            return self._body(now)
+
+        step = math.floor(now / self._granularity)
+        if step != self._cached_step:
+            self._cached_body = self._body(step * self._granularity)
+            self._cached_etag = b'"%08x-%x"' % (self._static_tag, step)
+            self._cached_step = step
+        remaining = (step + 1) * self._granularity - now
+        request.setHeader(b"ETag", self._cached_etag)
+        request.setHeader(
+            b"Cache-Control", b"public, max-age=%d" % max(0, int(remaining)))
+
+        if_none_match = request.getHeader(b"if-none-match")
+        if if_none_match is not None and (
+            if_none_match.strip() == b"*"
+            or self._cached_etag in (
+                _opaque_tag(tag) for tag in if_none_match.split(b","))
+        ):
+            request.setResponseCode(304)
+            return b""
+        return self._cached_body
+
+
+class BeaconNetworkResource(Resource):
+    """Every known server's /beacon/info, merged into one response.
+
+    Requests are answered from a cached aggregate. Past cache_seconds the
+    stale aggregate is still served while one fan-out refreshes it in the
+    background; past cache_seconds + stale_seconds (or before the first
+    fan-out) requests wait for the refresh. At most one fan-out is ever in
+    flight, and every request arriving meanwhile shares its result. The
+    fan-out is a background process, not part of the request that started
+    it.
+
+    skew_ms is the remote timestamp minus our clock at the midpoint of the
+    round trip. A server with cache_granularity_seconds advertises
+    timestamp_granularity; its timestamp is the start of a step, so the
+    middle of the step is used and skew_error_ms gives the half-width.
+    """
+
+    isLeaf = True
+
+    _PATH = "/_synapse/client/beacon/info"
+
+    def __init__(
+        self,
+        api,
+        servers: list[str],
+        timeout: float,
+        concurrency: int,
+        cache_seconds: float,
+        stale_seconds: float,
+    ):
+        super().__init__()
+        self._api = api
+        self._servers = servers
+        self._timeout = timeout
+        self._concurrency = max(1, concurrency)
+        self._cache_seconds = cache_seconds
+        self._stale_seconds = stale_seconds
+        self._body: bytes | None = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._waiters: list = []
+
+    def _age(self) -> float:
+        return time.monotonic() - self._fetched_at
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"application/json; charset=utf-8")
+        request.setHeader(b"Access-Control-Allow-Origin", b"*")
+        if self._body is not None and self._age() < self._cache_seconds:
+            return self._body
+        # May finish synchronously (no servers, or every fetch failing at
+        # once), so the cache is checked again afterwards
+        self._refresh()
+        if self._body is not None and self._age() < self._cache_seconds + self._stale_seconds:
+            return self._body
+        if not self._refreshing:
+            request.setResponseCode(503)
+            return _NETWORK_UNAVAILABLE
+        self._waiters.append(request)
+        request.notifyFinish().addErrback(lambda _: self._drop_waiter(request))
+        return NOT_DONE_YET
+
+    def _drop_waiter(self, request) -> None:
+        # The client went away before the fan-out finished
+        if request in self._waiters:
+            self._waiters.remove(request)
+
+    def _refresh(self) -> None:
+        if self._refreshing:
+            return
+        self._refreshing = True
+        self._api.run_as_background_process("beacon_network_refresh", self._fan_out)
+
+    async def _fan_out(self) -> None:
+        results: list[dict[str, Any]] = []
+
+        async def _fetch_into(server: str) -> None:
+            results.append(await self._fetch(server))
+
+        try:
+            await concurrently_execute(_fetch_into, self._servers, self._concurrency)
+            self._merged(results)
+        except Exception as e:
+            logger.error("event=NETWORK_ERROR error=%s", e)
+        finally:
+            # The waiters belong to their own requests, not to this process
+            with PreserveLoggingContext():
+                self._finish_refresh()
+
+    async def _fetch(self, server: str) -> dict[str, Any]:
+        try:
+            rtt, body = await make_deferred_yieldable(_fetch_json(
+                self._api.http_client, _server_url(server, self._PATH),
+                self._timeout))
+            granularity = float(body.get("timestamp_granularity") or 0)
+            remote_now = body["timestamp"] + granularity / 2
+        except Exception as e:
+            return {"server": server, "reachable": False, "error": str(e)}
+        skew = remote_now - (time.time() - rtt / 2)
+        merged = {
+            "server": server,
+            "reachable": True,
+            "rtt_ms": round(rtt * 1000, 1),
+            "region": body.get("region"),
+            "skew_ms": round(skew * 1000, 1),
+            "load": body.get("load"),
+        }
+        if granularity:
+            merged["skew_error_ms"] = round(granularity * 500, 1)
+        return merged
+
+    def _merged(self, results: list[dict[str, Any]]) -> None:
+        results.sort(key=lambda r: (not r["reachable"], r.get("rtt_ms") or 0.0))
+        self._body = json.dumps({
+            "servers": results,
+            "reachable": sum(1 for r in results if r["reachable"]),
+            "total": len(results),
             "timestamp": time.time(),
         }).encode("utf-8")
+        self._fetched_at = time.monotonic()
+
+    def _finish_refresh(self) -> None:
+        self._refreshing = False
+        waiters, self._waiters = self._waiters, []
+        code, body = 200, self._body
+        if body is None:
+            code, body = 503, _NETWORK_UNAVAILABLE
+        for request in waiters:
+            request.setResponseCode(code)
+            request.write(body)
+            request.finish()
+
+
+class BeaconTimeResource(Resource):
+    """The current login window and the time left in it.
+
+    Lets clients sign the window crypto_auth_provider expects on the first
+    try. Everything but the timing fields is fixed for a window, so that
+    part is encoded once per window.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        super().__init__()
+        self._window = None
+        self._prefix = b""
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"application/json; charset=utf-8")
+        request.setHeader(b"Access-Control-Allow-Origin", b"*")
+        request.setHeader(b"Cache-Control", b"no-store")
+        now = time.time()
+        window = int(now / WINDOW_SECONDS)
+        if window != self._window:
+            self._prefix = json.dumps({
+                "window": window,
+                "window_seconds": WINDOW_SECONDS,
+                "challenge": "login:{}".format(window),
+                "window_end": (window + 1) * WINDOW_SECONDS,
+            }).encode("utf-8")[:-1] + b', "remaining": '
+            self._window = window
+        remaining = (window + 1) * WINDOW_SECONDS - now
+        return b"%s%.3f, \"timestamp\": %s}" % (
+            self._prefix, remaining, repr(now).encode("ascii"))
 
 
 class BeaconInfoModule:
@@ -37,11 +483,66 @@ class BeaconInfoModule:
         logger.info("event=INIT config=%s", config)
         self.config = config
         self.api = api
+        self.resource = BeaconInfoResource(config)
         self.api.register_web_resource(
             path="/_synapse/client/beacon/info",
-            resource=BeaconInfoResource(config),
+            resource=self.resource,
+        )
+
+        self.api.register_web_resource(
+            path="/_synapse/client/beacon/time",
+            resource=BeaconTimeResource(),
         )
 
+        timeout = float(config.get("probe_timeout_seconds", 5))
+        self.api.register_web_resource(
+            path="/_synapse/client/beacon/network",
+            resource=BeaconNetworkResource(
+                self.api,
+                config.get("known_servers", []),
+                timeout,
+                int(config.get("network_concurrency", 16)),
+                float(config.get("network_cache_seconds", 30)),
+                float(config.get("network_stale_seconds", 300)),
+            ),
+        )
+
+        self.prober = None
+        interval = float(config.get("probe_interval_seconds", 0))
+        if interval > 0 and config.get("known_servers"):
+            self.prober = _ServerProber(
+                self.api.http_client,
+                config["known_servers"],
+                config.get("probe_path", "/_matrix/federation/v1/version"),
+                timeout,
+                int(config.get("probe_concurrency", 4)),
+                self.resource.set_servers,
+            )
+            # The jitter offsets this node's rounds from other nodes'
+            jitter = float(config.get("probe_jitter_seconds", min(interval, 5)))
+            reactor.callLater(
+                random.uniform(0, jitter),
+                self.api.looping_background_call,
+                self.prober.probe_all,
+                interval * 1000,
+                desc="beacon_info_probe_servers",
+                run_on_all_instances=bool(config.get("probe_on_all_instances", False)),
+            )
+
+        self.load = None
+        load_interval = float(config.get("load_interval_seconds", 15))
+        if load_interval > 0:
+            self.load = _LoadSampler(
+                config.get("load_lag_metrics", ["synapse_event_processing_lag"]),
+                self.resource.set_load,
+            )
+            self.api.looping_background_call(
+                self.load.sample,
+                load_interval * 1000,
+                desc="beacon_info_sample_load",
+                run_on_all_instances=True,
+            )
+
     @staticmethod
     def parse_config(config: dict[str, Any]) -> dict[str, Any]:
         return config
@@ -13,22 +13,130 @@
 # Register in homeserver.yaml:
 #   modules:
 #     - module: beacon_monitor_module.BeaconMonitorModule
-#       config: {}
+#       config:
+#         max_tracked_rooms: 100000   # rooms kept in the member-count index
+#         room_idle_seconds: 86400    # drop rooms with no membership change
+#         async_logging: false        # format/write log lines on a background thread
+#         log_buffer_size: 10000
+#         log_drop_policy: oldest     # or "newest", when the buffer is full
+#         log_flush_interval_ms: 100
+#         log_events: true            # false keeps only the Prometheus aggregates
+#         event_types:                # events outside this list are ignored entirely
+#           - m.room.member
+#           - m.room.create
+#           - m.room.message
+#           - m.room.encryption
+#         sample_rates:               # fraction of rooms whose events are logged
+#           m.room.message: 0.1
+#         room_log_rate_limit: 0      # max log lines per room per second, 0 = no limit
+#         federation_stats: true      # per-remote-server event age quantiles
+#         max_tracked_servers: 1000
+#         server_idle_seconds: 86400
+#         pairing_tracking: true      # create -> join -> first message timing per room
+#         pairing_timeout_seconds: 600
+#         max_pairing_sessions: 100000
+#         traffic_tracking: true      # hot rooms/senders by messages and bytes
+#         traffic_top_n: 20
+#         traffic_window_seconds: 300
+#         offload: false              # analyse events off the persistence path
+#         offload_queue_size: 10000
+#         offload_batch_size: 500
+#         login_stats: true           # login rate, distinct users, new vs returning
+#         login_window_seconds: 300
+#         login_known_users: 100000   # users remembered to tell new from returning
 
+import hashlib
+import heapq
+import itertools
 import logging
+import math
+import sys
+import threading
 import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
 from typing import Any
 
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from twisted.internet import reactor
+
+from synapse.api.errors import SynapseError
 from synapse.events import EventBase
-from synapse.module_api import ModuleApi
+from synapse.module_api import DirectServeJsonResource, ModuleApi
 from synapse.types import StateMap
 
 log = logging.getLogger(__name__)
 
+_HANDLED_EVENT_TYPES = (
+    "m.room.member",
+    "m.room.create",
+    "m.room.message",
+    "m.room.encryption",
+)
+
+log_queue_depth = Gauge(
+    "beacon_monitor_log_queue_depth",
+    "Log records waiting for the background writer")
+log_dropped = Counter(
+    "beacon_monitor_log_dropped_total",
+    "Log records dropped because the buffer was full")
+
+message_body_bytes = Histogram(
+    "beacon_monitor_message_body_bytes",
+    "Size of m.room.message bodies (encrypted Beacon payloads)",
+    ["origin"],
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576))
+event_age_seconds = Histogram(
+    "beacon_monitor_event_age_seconds",
+    "Time between an event's origin_server_ts and this server seeing it",
+    ["origin"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+membership_transitions = Counter(
+    "beacon_monitor_membership_total",
+    "Membership events by resulting membership and target user origin",
+    ["membership", "origin"])
+rooms_created = Counter(
+    "beacon_monitor_rooms_created_total",
+    "Rooms created, by creator origin",
+    ["origin"])
+tracked_rooms = Gauge(
+    "beacon_monitor_tracked_rooms",
+    "Rooms in the member index, by whether they have remote members",
+    ["room_type"])
+offload_queue_depth = Gauge(
+    "beacon_monitor_offload_queue_depth",
+    "Event records waiting to be processed in offload mode")
+offload_dropped = Counter(
+    "beacon_monitor_offload_dropped_total",
+    "Event records dropped because the offload queue was full")
+offload_lag_seconds = Histogram(
+    "beacon_monitor_offload_lag_seconds",
+    "Time event records spend in the offload queue",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10))
+logins = Counter(
+    "beacon_monitor_logins_total",
+    "Logins, by user origin and auth provider type",
+    ["origin", "provider_type"])
+state_bytes = Gauge(
+    "beacon_monitor_state_bytes",
+    "Approximate memory held by the monitor's in-memory state",
+    ["structure"])
+federated_room_ratio = Gauge(
+    "beacon_monitor_federated_room_ratio",
+    "Fraction of tracked rooms with at least one remote member")
+
 
-def _event_age_ms(event: EventBase) -> int:
-    """How many ms ago the event was created (origin_server_ts vs now)."""
-    return int(time.time() * 1000) - event.origin_server_ts
+_QUANTILES = (0.5, 0.95, 0.99)
+# Records measured per structure when estimating state_bytes
+_SIZE_SAMPLE = 64
+# HyperLogLog registers per sketch (2**12 bytes, ~1.6% standard error)
+_HLL_PRECISION = 12
+# Sub-windows the login window slides in
+_LOGIN_SLICES = 10
+# A (count, key) tuple in a _SpaceSaving heap, excluding the shared key
+_HEAP_ENTRY_BYTES = sys.getsizeof((0, ""))
 
 
 def _user_server(user_id: str) -> str:
@@ -36,10 +144,1045 @@ def _user_server(user_id: str) -> str:
     return user_id.split(":", 1)[1] if ":" in user_id else "unknown"
 
 
+def _discard(level: int, msg: str, *args: Any) -> None:
+    """Log sink used when per-event log lines are turned off."""
+
+
+def _approx_bytes(container, record_bytes) -> int:
+    """Approximate memory held by a mapping and its records.
+
+    Record sizes are measured on a small sample and extrapolated, so this
+    stays O(1) however many rooms are tracked.
+    """
+    total = sys.getsizeof(container)
+    count = len(container)
+    if count:
+        try:
+            sample = list(itertools.islice(container.items(), _SIZE_SAMPLE))
+            if sample:
+                total += count * sum(record_bytes(k, v) for k, v in sample) // len(sample)
+        except RuntimeError:
+            # The container or a record (e.g. a room's member set) was
+            # mutated mid-sample by the reactor thread; report what we have
+            return total
+    return total
+
+
+def _room_sampled(room_id: str, rate: float) -> bool:
+    """Deterministic per-room sampling: a room is either always or never
+    sampled at a given rate, so sampled rooms get complete traces."""
+    return zlib.crc32(room_id.encode()) < rate * 0x100000000
+
+
+class _EventRecord:
+    """The fields of an event the monitor needs, captured in the callback.
+
+    age_ms is taken at capture time, so it stays accurate when the record
+    is processed later. state_events is only kept for membership events,
+    whose room may need a first-time recount.
+    """
+
+    __slots__ = (
+        "type", "room_id", "sender", "state_key", "membership",
+        "origin_server_ts", "arrival_ms", "body_bytes", "detail",
+        "state_events", "seq",
+    )
+
+    def __init__(self, event: EventBase, state_events: StateMap[EventBase]):
+        content = event.content
+        self.type = event.type
+        # Interned so every tracking structure shares one copy of each ID
+        self.room_id = sys.intern(event.room_id)
+        self.sender = sys.intern(event.sender)
+        self.origin_server_ts = event.origin_server_ts
+        self.arrival_ms = int(time.time() * 1000)
+        self.state_key = None
+        self.membership = None
+        self.body_bytes = 0
+        self.detail = None
+        self.state_events = None
+        # Position in the offload queue (0 when processed inline)
+        self.seq = 0
+        if self.type == "m.room.member":
+            self.state_key = sys.intern(event.state_key or "unknown")
+            self.membership = content.get("membership", "unknown")
+            self.state_events = state_events
+        elif self.type == "m.room.message":
+            body = content.get("body", "")
+            self.body_bytes = len(body.encode("utf-8")) if isinstance(body, str) else 0
+            self.detail = content.get("msgtype", "unknown")
+        elif self.type == "m.room.encryption":
+            self.detail = content.get("algorithm", "unknown")
+
+    @property
+    def age_ms(self) -> int:
+        """How many ms after origin_server_ts this server saw the event."""
+        return self.arrival_ms - self.origin_server_ts
+
+
+class _RoomMembers:
+    """Joined members of one room and how many of them are local."""
+
+    __slots__ = ("joined", "local", "last_seen")
+
+    def __init__(self) -> None:
+        self.joined: dict[str, bool] = {}
+        self.local = 0
+        # Whole seconds on the monotonic clock
+        self.last_seen = 0
+
+    @property
+    def remote(self) -> int:
+        return len(self.joined) - self.local
+
+    def set_membership(self, user_id: str, is_local: bool, joined: bool) -> None:
+        was_joined = user_id in self.joined
+        if joined and not was_joined:
+            self.joined[user_id] = is_local
+            self.local += is_local
+        elif not joined and was_joined:
+            self.local -= self.joined.pop(user_id)
+
+
+class _MemberIndex:
+    """Local/remote joined-member counts per room, kept up to date
+    incrementally.
+
+    A room's full state is only walked the first time the room is seen (or
+    after it was evicted); later membership events adjust the counts from
+    their own transition. At most max_rooms rooms are kept, least recently
+    active first out, and rooms idle for idle_seconds are dropped.
+    """
+
+    def __init__(self, server_name: str, max_rooms: int, idle_seconds: float):
+        self._local_suffix = ":" + server_name
+        self._max_rooms = max_rooms
+        self._idle_seconds = idle_seconds
+        self._rooms: OrderedDict[str, _RoomMembers] = OrderedDict()
+        # Rooms with at least one remote member, kept in step with _rooms
+        self.federated = 0
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def federated_ratio(self) -> float:
+        return self.federated / len(self._rooms) if self._rooms else 0.0
+
+    def approx_bytes(self) -> int:
+        return _approx_bytes(self._rooms, lambda room_id, room: (
+            sys.getsizeof(room_id) + sys.getsizeof(room)
+            + sys.getsizeof(room.joined)
+            + sum(sys.getsizeof(user_id) for user_id in room.joined)))
+
+    def _is_local(self, user_id: str) -> bool:
+        return user_id.endswith(self._local_suffix)
+
+    def update(
+        self,
+        room_id: str,
+        user_id: str,
+        membership: str,
+        state_events: StateMap[EventBase],
+    ) -> _RoomMembers:
+        now = int(time.monotonic())
+        room = self._rooms.get(room_id)
+        if room is None:
+            # state_events already reflects this event, so a recount
+            # includes it
+            room = self._recount(state_events)
+            self._rooms[room_id] = room
+            self.federated += room.remote > 0
+        else:
+            was_federated = room.remote > 0
+            room.set_membership(
+                user_id, self._is_local(user_id), membership == "join")
+            self.federated += (room.remote > 0) - was_federated
+            self._rooms.move_to_end(room_id)
+        room.last_seen = now
+        self._evict(now)
+        return room
+
+    def _recount(self, state_events: StateMap[EventBase]) -> _RoomMembers:
+        room = _RoomMembers()
+        for (etype, skey), state_event in state_events.items():
+            if etype != "m.room.member":
+                continue
+            if state_event.content.get("membership") != "join":
+                continue
+            room.set_membership(sys.intern(skey), self._is_local(skey), True)
+        return room
+
+    def _evict(self, now: int) -> None:
+        rooms = self._rooms
+        while len(rooms) > self._max_rooms:
+            self._drop_oldest()
+        idle_before = now - self._idle_seconds
+        while rooms:
+            oldest = next(iter(rooms.values()))
+            if oldest.last_seen >= idle_before:
+                break
+            self._drop_oldest()
+
+    def _drop_oldest(self) -> None:
+        _room_id, room = self._rooms.popitem(last=False)
+        self.federated -= room.remote > 0
+
+    def forget(self, room_id: str) -> None:
+        """Drop a room whose counts can no longer be trusted."""
+        room = self._rooms.pop(room_id, None)
+        if room is not None:
+            self.federated -= room.remote > 0
+
+
+class _LatencySketch:
+    """Streaming quantile sketch over log-spaced buckets.
+
+    Bucket i > 0 holds values in [GAMMA**(i-1), GAMMA**i) ms, so quantiles
+    are within ~5% relative error; bucket 0 holds anything under 1 ms
+    (including negative ages from clock skew). Memory is fixed at one
+    array of BUCKETS counters.
+    """
+
+    __slots__ = ("counts", "count")
+
+    GAMMA = 1.1
+    BUCKETS = 170  # the last bucket starts at GAMMA**168 ms, ~2.5 hours
+    _LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self) -> None:
+        self.counts = array("L", bytes(self.BUCKETS * array("L").itemsize))
+        self.count = 0
+
+    def add(self, value_ms: float) -> None:
+        if value_ms < 1:
+            index = 0
+        else:
+            index = min(
+                self.BUCKETS - 1, int(math.log(value_ms) / self._LOG_GAMMA) + 1)
+        self.counts[index] += 1
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimated q-quantile in ms (0.0 if nothing was recorded)."""
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen > rank:
+                return 0.0 if index == 0 else self.GAMMA ** (index - 0.5)
+        return self.GAMMA ** (self.BUCKETS - 1)
+
+
+class _ServerStats:
+    """Event age on arrival from one remote server."""
+
+    __slots__ = ("sketch", "last_seen")
+
+    def __init__(self) -> None:
+        self.sketch = _LatencySketch()
+        # Whole seconds since the epoch
+        self.last_seen = 0
+
+
+class _FederationStats:
+    """Per-remote-server arrival latency, for spotting slow federation peers.
+
+    At most max_servers servers are tracked, least recently seen first out,
+    and servers not heard from for idle_seconds are dropped: on the next
+    remote event or expire() call, and left out of snapshots until then.
+    """
+
+    def __init__(self, max_servers: int, idle_seconds: float):
+        self._max_servers = max_servers
+        self._idle_seconds = idle_seconds
+        self._servers: OrderedDict[str, _ServerStats] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._servers)
+
+    def approx_bytes(self) -> int:
+        return _approx_bytes(self._servers, lambda server, stats: (
+            sys.getsizeof(server) + sys.getsizeof(stats)
+            + sys.getsizeof(stats.sketch) + sys.getsizeof(stats.sketch.counts)))
+
+    def record(self, server: str, age_ms: int) -> None:
+        if self._max_servers <= 0:
+            return
+        now = int(time.time())
+        stats = self._servers.get(server)
+        if stats is None:
+            stats = self._servers[server] = _ServerStats()
+        else:
+            self._servers.move_to_end(server)
+        stats.sketch.add(age_ms)
+        stats.last_seen = now
+
+        servers = self._servers
+        while len(servers) > self._max_servers:
+            servers.popitem(last=False)
+        self.expire(now)
+
+    def expire(self, now: int) -> None:
+        """Drop servers idle since before now - idle_seconds. Reactor only."""
+        servers = self._servers
+        idle_before = now - self._idle_seconds
+        while servers and next(iter(servers.values())).last_seen < idle_before:
+            servers.popitem(last=False)
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        """Per-server summaries, slowest p95 first.
+
+        Read-only, as the metrics collector calls it from its own thread.
+        """
+        idle_before = int(time.time()) - self._idle_seconds
+        servers = [
+            {
+                "server": server,
+                "events": stats.sketch.count,
+                "last_seen": stats.last_seen,
+                **{
+                    "p{}_ms".format(int(q * 100)): round(stats.sketch.quantile(q), 1)
+                    for q in _QUANTILES
+                },
+            }
+            for server, stats in list(self._servers.items())
+            if stats.last_seen >= idle_before
+        ]
+        servers.sort(key=lambda entry: entry["p95_ms"], reverse=True)
+        return servers
+
+
+pairing_seconds = Histogram(
+    "beacon_monitor_pairing_seconds",
+    "Pairing phase durations: room creation to peer join, and peer join "
+    "to first message",
+    ["phase"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+pairings_completed = Counter(
+    "beacon_monitor_pairings_completed_total",
+    "Rooms that went from creation to a first message after the peer joined")
+pairings_incomplete = Counter(
+    "beacon_monitor_pairings_incomplete_total",
+    "Pairings that never completed, by the last stage reached",
+    ["stage", "reason"])
+
+
+class _FederationCollector:
+    """Exports the module's _FederationStats to Prometheus at scrape time."""
+
+    def __init__(self) -> None:
+        self.stats: _FederationStats | None = None
+
+    def collect(self):
+        age = GaugeMetricFamily(
+            "beacon_monitor_federation_event_age_seconds",
+            "Estimated quantiles of event age on arrival, per remote server",
+            labels=["server", "quantile"])
+        events = CounterMetricFamily(
+            "beacon_monitor_federation_events",
+            "Events received from each remote server",
+            labels=["server"])
+        last_seen = GaugeMetricFamily(
+            "beacon_monitor_federation_last_seen_timestamp_seconds",
+            "When an event from each remote server was last seen",
+            labels=["server"])
+        for entry in self.stats.snapshot() if self.stats is not None else ():
+            server = entry["server"]
+            for q in _QUANTILES:
+                age.add_metric(
+                    [server, str(q)],
+                    entry["p{}_ms".format(int(q * 100))] / 1000)
+            events.add_metric([server], entry["events"])
+            last_seen.add_metric([server], entry["last_seen"])
+        yield age
+        yield events
+        yield last_seen
+
+
+_federation_collector = _FederationCollector()
+REGISTRY.register(_federation_collector)
+
+
+class _TrafficCollector:
+    """Exports the module's hot rooms and senders to Prometheus."""
+
+    _FAMILIES = (
+        ("rooms_by_messages", "beacon_monitor_hot_room_messages", "room",
+         "Messages in the busiest rooms over the traffic window"),
+        ("rooms_by_bytes", "beacon_monitor_hot_room_bytes", "room",
+         "Payload bytes in the busiest rooms over the traffic window"),
+        ("senders_by_messages", "beacon_monitor_hot_sender_messages", "sender",
+         "Messages from the busiest senders over the traffic window"),
+        ("senders_by_bytes", "beacon_monitor_hot_sender_bytes", "sender",
+         "Payload bytes from the busiest senders over the traffic window"),
+    )
+
+    def __init__(self) -> None:
+        self.tracker: _TrafficTracker | None = None
+
+    def collect(self):
+        snapshot = self.tracker.snapshot() if self.tracker is not None else {}
+        for key, name, label, documentation in self._FAMILIES:
+            family = GaugeMetricFamily(name, documentation, labels=[label])
+            for item, value in snapshot.get(key, ()):
+                family.add_metric([item], value)
+            yield family
+
+
+_traffic_collector = _TrafficCollector()
+REGISTRY.register(_traffic_collector)
+
+
+class _LoginCollector:
+    """Exports the module's login rate estimates to Prometheus."""
+
+    def __init__(self) -> None:
+        self.tracker: _LoginTracker | None = None
+
+    def collect(self):
+        rate = GaugeMetricFamily(
+            "beacon_monitor_login_rate",
+            "Logins per second over the login window, by user origin",
+            labels=["origin"])
+        distinct = GaugeMetricFamily(
+            "beacon_monitor_login_distinct_users",
+            "Estimated distinct users logging in over the login window")
+        new_ratio = GaugeMetricFamily(
+            "beacon_monitor_login_new_ratio",
+            "Fraction of logins over the login window by users not seen before")
+        if self.tracker is not None:
+            snapshot = self.tracker.snapshot()
+            for origin, value in snapshot["logins_per_second"].items():
+                rate.add_metric([origin], value)
+            distinct.add_metric([], snapshot["distinct_users"])
+            new_ratio.add_metric([], snapshot["new_ratio"])
+        yield rate
+        yield distinct
+        yield new_ratio
+
+
+_login_collector = _LoginCollector()
+REGISTRY.register(_login_collector)
+
+
+class FederationStatsResource(DirectServeJsonResource):
+    """Per-remote-server federation statistics as JSON. Server admins only,
+    as the list names every server this relay federates with."""
+
+    isLeaf = True
+
+    def __init__(self, api: ModuleApi, stats: _FederationStats):
+        super().__init__()
+        self._api = api
+        self._stats = stats
+
+    async def _async_render_GET(self, request) -> tuple[int, dict[str, Any]]:
+        requester = await self._api.get_user_by_req(request)
+        if not await self._api.is_user_admin(requester.user.to_string()):
+            raise SynapseError(403, "You are not a server admin", "M_FORBIDDEN")
+        return 200, {
+            "servers": self._stats.snapshot(),
+            "timestamp": time.time(),
+        }
+
+
+class _PairingSession:
+    """Milestones of one Beacon pairing, in ms since the epoch (0 = not yet)."""
+
+    __slots__ = ("creator", "created_ms", "invited_ms", "joined_ms")
+
+    def __init__(self, creator: str, created_ms: int) -> None:
+        self.creator = creator
+        self.created_ms = created_ms
+        self.invited_ms = 0
+        self.joined_ms = 0
+
+    @property
+    def stage(self) -> str:
+        if self.joined_ms:
+            return "joined"
+        if self.invited_ms:
+            return "invited"
+        return "created"
+
+
+class _PairingTracker:
+    """Correlates a room's creation, invite, peer join and first message.
+
+    A Beacon pairing is one side creating a room and inviting the other,
+    which joins and sends the first message. Times are taken when this
+    server sees each event. Sessions still open after timeout_ms are
+    expired as incomplete; at most max_sessions are open at once, oldest
+    evicted first.
+    """
+
+    def __init__(self, max_sessions: int, timeout_ms: int):
+        self._max_sessions = max_sessions
+        self._timeout_ms = timeout_ms
+        # Insertion order is creation order, so expiry scans from the front
+        self._sessions: OrderedDict[str, _PairingSession] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def approx_bytes(self) -> int:
+        return _approx_bytes(self._sessions, lambda room_id, session: (
+            sys.getsizeof(room_id) + sys.getsizeof(session)))
+
+    def on_create(self, room_id: str, creator: str, now_ms: int) -> None:
+        self._sessions[room_id] = _PairingSession(creator, now_ms)
+        while len(self._sessions) > self._max_sessions:
+            _room_id, session = self._sessions.popitem(last=False)
+            pairings_incomplete.labels(session.stage, "evicted").inc()
+
+    def on_membership(
+        self, room_id: str, user_id: str, membership: str, now_ms: int
+    ) -> None:
+        session = self._sessions.get(room_id)
+        if session is None:
+            return
+        if membership == "invite" and not session.invited_ms:
+            session.invited_ms = now_ms
+        elif (membership == "join" and not session.joined_ms
+                and user_id != session.creator):
+            session.joined_ms = now_ms
+
+    def on_message(self, room_id: str, now_ms: int) -> _PairingSession | None:
+        """Return the session if this message completes its pairing."""
+        session = self._sessions.get(room_id)
+        if session is None or not session.joined_ms:
+            return None
+        del self._sessions[room_id]
+        return session
+
+    def expire(self, now_ms: int) -> list[tuple[str, _PairingSession]]:
+        expired = []
+        cutoff = now_ms - self._timeout_ms
+        sessions = self._sessions
+        while sessions:
+            room_id, session = next(iter(sessions.items()))
+            if session.created_ms >= cutoff:
+                break
+            del sessions[room_id]
+            expired.append((room_id, session))
+        return expired
+
+
+class _SpaceSaving:
+    """Approximate heavy hitters in fixed memory (Space-Saving, Metwally et
+    al. 2005).
+
+    Holds at most capacity keys. A new key past capacity replaces the
+    smallest one and inherits its count as overestimation error, so any key
+    with a true total above total/capacity is guaranteed to be present.
+
+    The smallest key is found through a lazily updated min-heap holding one
+    (count, key) entry per key. Increments leave heap entries stale (too
+    low); an eviction re-pushes stale entries until the top is current,
+    which makes it the true minimum. Weighted adds (bytes) rule out the
+    count-bucket Stream-Summary list.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        # key -> [count, error]
+        self.counters: dict[str, list[int]] = {}
+        self._heap: list[tuple[int, str]] = []
+
+    def approx_bytes(self) -> int:
+        return sys.getsizeof(self._heap) + _approx_bytes(
+            self.counters, lambda key, entry: (
+                sys.getsizeof(key) + sys.getsizeof(entry) + _HEAP_ENTRY_BYTES))
+
+    def add(self, key: str, weight: int = 1) -> None:
+        counters = self.counters
+        entry = counters.get(key)
+        if entry is not None:
+            entry[0] += weight
+            return
+        heap = self._heap
+        if len(counters) < self._capacity:
+            counters[key] = [weight, 0]
+            heapq.heappush(heap, (weight, key))
+            return
+        while True:
+            floor, victim = heap[0]
+            count = counters[victim][0]
+            if count == floor:
+                break
+            heapq.heapreplace(heap, (count, victim))
+        del counters[victim]
+        counters[key] = [floor + weight, floor]
+        heapq.heapreplace(heap, (floor + weight, key))
+
+
+class _TrafficWindow:
+    """Heavy-hitter sketches for one time window."""
+
+    __slots__ = (
+        "started", "room_messages", "room_bytes", "sender_messages",
+        "sender_bytes",
+    )
+
+    def __init__(self, capacity: int, started: float):
+        self.started = started
+        self.room_messages = _SpaceSaving(capacity)
+        self.room_bytes = _SpaceSaving(capacity)
+        self.sender_messages = _SpaceSaving(capacity)
+        self.sender_bytes = _SpaceSaving(capacity)
+
+
+class _TrafficTracker:
+    """Top rooms and senders by message count and payload bytes.
+
+    Two tumbling windows are kept and summed, which approximates a sliding
+    window of one to two window_seconds. Memory is fixed at four
+    Space-Saving sketches per window.
+
+    Only record() (reactor thread) rotates windows. snapshot() is also
+    called from the metrics thread, so it reads the (previous, current)
+    pair once and works out which of them are still live without
+    changing anything.
+    """
+
+    def __init__(self, top_n: int, window_seconds: float):
+        self._top_n = top_n
+        self._capacity = max(100, top_n * 10)
+        self._window_seconds = window_seconds
+        now = time.monotonic()
+        # (previous, current), replaced as a whole so readers see a
+        # consistent pair
+        self._windows = (
+            _TrafficWindow(self._capacity, now - window_seconds),
+            _TrafficWindow(self._capacity, now),
+        )
+
+    def approx_bytes(self) -> int:
+        return sum(
+            sketch.approx_bytes()
+            for window in self._windows
+            for sketch in (
+                window.room_messages, window.room_bytes,
+                window.sender_messages, window.sender_bytes)
+        )
+
+    def _rotate(self, now: float) -> _TrafficWindow:
+        current = self._windows[1]
+        if now - current.started < self._window_seconds:
+            return current
+        if now - current.started >= 2 * self._window_seconds:
+            # Idle for more than a full window: nothing recent to keep
+            previous = _TrafficWindow(self._capacity, now - self._window_seconds)
+        else:
+            previous = current
+        current = _TrafficWindow(self._capacity, now)
+        self._windows = (previous, current)
+        return current
+
+    def record(self, room_id: str, sender: str, body_bytes: int) -> None:
+        window = self._rotate(time.monotonic())
+        window.room_messages.add(room_id)
+        window.room_bytes.add(room_id, body_bytes)
+        window.sender_messages.add(sender)
+        window.sender_bytes.add(sender, body_bytes)
+
+    def _live(self, now: float) -> tuple[_TrafficWindow, ...]:
+        """The windows a rotation at now would keep."""
+        previous, current = self._windows
+        age = now - current.started
+        if age < self._window_seconds:
+            return (previous, current)
+        if age < 2 * self._window_seconds:
+            return (current,)
+        return ()
+
+    def _top(self, windows, attribute: str) -> list[tuple[str, int]]:
+        totals: dict[str, int] = {}
+        for window in windows:
+            for key, (count, _error) in list(getattr(window, attribute).counters.items()):
+                totals[key] = totals.get(key, 0) + count
+        return sorted(totals.items(), key=lambda kv: kv[1], reverse=True)[: self._top_n]
+
+    def snapshot(self) -> dict[str, Any]:
+        windows = self._live(time.monotonic())
+        return {
+            "window_seconds": self._window_seconds,
+            "rooms_by_messages": self._top(windows, "room_messages"),
+            "rooms_by_bytes": self._top(windows, "room_bytes"),
+            "senders_by_messages": self._top(windows, "sender_messages"),
+            "senders_by_bytes": self._top(windows, "sender_bytes"),
+        }
+
+
+class TrafficStatsResource(DirectServeJsonResource):
+    """Hot rooms and senders as JSON. Server admins only.
+
+    DirectServeJsonResource turns any exception into a JSON error response,
+    so a request is always finished.
+    """
+
+    isLeaf = True
+
+    def __init__(self, api: ModuleApi, tracker: _TrafficTracker):
+        super().__init__()
+        self._api = api
+        self._tracker = tracker
+
+    async def _async_render_GET(self, request) -> tuple[int, dict[str, Any]]:
+        requester = await self._api.get_user_by_req(request)
+        if not await self._api.is_user_admin(requester.user.to_string()):
+            raise SynapseError(403, "You are not a server admin", "M_FORBIDDEN")
+        return 200, self._tracker.snapshot()
+
+
+class _HyperLogLog:
+    """Distinct-count estimate in fixed memory (HyperLogLog, Flajolet et
+    al. 2007), one byte per register."""
+
+    __slots__ = ("registers",)
+
+    _INDEX_SHIFT = 64 - _HLL_PRECISION
+    _RANK_MASK = (1 << _INDEX_SHIFT) - 1
+
+    def __init__(self) -> None:
+        self.registers = bytearray(1 << _HLL_PRECISION)
+
+    def add(self, item: str) -> None:
+        hashed = int.from_bytes(
+            hashlib.blake2b(item.encode(), digest_size=8).digest(), "big")
+        index = hashed >> self._INDEX_SHIFT
+        rank = self._INDEX_SHIFT - (hashed & self._RANK_MASK).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    @staticmethod
+    def estimate(registers: bytes) -> float:
+        m = len(registers)
+        raw = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in registers)
+        zeros = registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Small-range correction: linear counting over empty registers
+            return m * math.log(m / zeros)
+        return raw
+
+
+class _LoginSlice:
+    """Login counts for one sub-window."""
+
+    __slots__ = ("index", "local", "remote", "new", "users")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.local = 0
+        self.remote = 0
+        self.new = 0
+        self.users = _HyperLogLog()
+
+
+class _LoginTracker:
+    """Login rate, distinct users and new vs returning logins over a window.
+
+    The window is split into _LOGIN_SLICES sub-windows, so it slides in
+    steps of window_seconds / _LOGIN_SLICES. Distinct users come from
+    merging the slices' HyperLogLog registers. A login is "new" when the
+    user is not among the known_users most recently seen ones, which after
+    a restart includes everyone.
+    """
+
+    def __init__(self, window_seconds: float, known_users: int):
+        self._window_seconds = window_seconds
+        self._slice_seconds = window_seconds / _LOGIN_SLICES
+        self._slices: deque[_LoginSlice] = deque(maxlen=_LOGIN_SLICES)
+        self._known_users = known_users
+        self._seen: OrderedDict[str, None] = OrderedDict()
+
+    def approx_bytes(self) -> int:
+        return len(self._slices) * (1 << _HLL_PRECISION) + _approx_bytes(
+            self._seen, lambda user_id, _value: sys.getsizeof(user_id))
+
+    def _slice(self, now: float) -> _LoginSlice:
+        index = int(now / self._slice_seconds)
+        slices = self._slices
+        if not slices or slices[-1].index != index:
+            slices.append(_LoginSlice(index))
+        return slices[-1]
+
+    def record(self, user_id: str, origin: str) -> None:
+        current = self._slice(time.monotonic())
+        if origin == "local":
+            current.local += 1
+        else:
+            current.remote += 1
+        current.users.add(user_id)
+
+        seen = self._seen
+        if user_id in seen:
+            seen.move_to_end(user_id)
+        else:
+            current.new += 1
+            seen[user_id] = None
+            if len(seen) > self._known_users:
+                seen.popitem(last=False)
+
+    def snapshot(self) -> dict[str, Any]:
+        oldest = int(time.monotonic() / self._slice_seconds) - _LOGIN_SLICES
+        live = [s for s in list(self._slices) if s.index > oldest]
+        local = sum(s.local for s in live)
+        remote = sum(s.remote for s in live)
+        # Register-wise max merges the slices into an empty sketch
+        registers = bytes(1 << _HLL_PRECISION)
+        for s in live:
+            registers = bytes(map(max, registers, s.users.registers))
+        total = local + remote
+        return {
+            "window_seconds": self._window_seconds,
+            "logins_per_second": {
+                "local": local / self._window_seconds,
+                "remote": remote / self._window_seconds,
+            },
+            "distinct_users": round(_HyperLogLog.estimate(registers)),
+            "new_ratio": sum(s.new for s in live) / total if total else 0.0,
+        }
+
+
+class _RateWindow:
+    """Log lines emitted for one room in the current second."""
+
+    __slots__ = ("second", "lines")
+
+    def __init__(self, second: int) -> None:
+        self.second = second
+        self.lines = 1
+
+
+class _RoomRateLimiter:
+    """Caps log lines per room per second, tracking at most max_rooms rooms."""
+
+    def __init__(self, limit: int, max_rooms: int):
+        self._limit = limit
+        self._max_rooms = max_rooms
+        self._rooms: OrderedDict[str, _RateWindow] = OrderedDict()
+        self.suppressed = 0
+
+    def approx_bytes(self) -> int:
+        return _approx_bytes(self._rooms, lambda room_id, window: (
+            sys.getsizeof(room_id) + sys.getsizeof(window)))
+
+    def allow(self, room_id: str) -> bool:
+        second = int(time.monotonic())
+        window = self._rooms.get(room_id)
+        if window is None:
+            self._rooms[room_id] = _RateWindow(second)
+            if len(self._rooms) > self._max_rooms:
+                self._rooms.popitem(last=False)
+            return True
+        self._rooms.move_to_end(room_id)
+        if window.second != second:
+            window.second = second
+            window.lines = 1
+            return True
+        if window.lines >= self._limit:
+            self.suppressed += 1
+            return False
+        window.lines += 1
+        return True
+
+
+class _LogPipeline:
+    """Writes log records from a background thread, in batches.
+
+    Callbacks only append (level, msg, args) to a bounded buffer; %-formatting
+    and handler I/O, which can block on stdout, happen on the writer thread.
+    When the buffer is full either the oldest queued record or the incoming
+    one is dropped, so logging never holds up event persistence.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        capacity: int,
+        drop_policy: str,
+        flush_interval: float,
+    ):
+        if drop_policy not in ("oldest", "newest"):
+            raise ValueError("log_drop_policy must be 'oldest' or 'newest'")
+        self._logger = logger
+        self._capacity = max(1, capacity)
+        self._drop_oldest = drop_policy == "oldest"
+        self._flush_interval = flush_interval
+        self._buffer: deque[tuple[int, str, tuple]] = deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self.dropped = 0
+        self._thread = threading.Thread(
+            target=self._run, name="beacon-monitor-log", daemon=True)
+        # Started with the reactor: Synapse daemonizes after loading modules,
+        # and a thread started before the fork would not survive it
+        reactor.callWhenRunning(self._thread.start)
+        log_queue_depth.set_function(lambda: len(self._buffer))
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def log(self, level: int, msg: str, *args: Any) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        buffer = self._buffer
+        if len(buffer) >= self._capacity:
+            self.dropped += 1
+            log_dropped.inc()
+            if not self._drop_oldest:
+                return
+            try:
+                buffer.popleft()
+            except IndexError:
+                pass
+        buffer.append((level, msg, args))
+        if len(buffer) >= self._capacity // 2:
+            self._wakeup.set()
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+        else:
+            self._flush()
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self) -> None:
+        buffer = self._buffer
+        while True:
+            try:
+                level, msg, args = buffer.popleft()
+            except IndexError:
+                return
+            self._logger.log(level, msg, *args)
+
+
 class BeaconMonitorModule:
     def __init__(self, config: dict[str, Any], api: ModuleApi):
         self._api = api
         self._server_name = api.server_name
+        self._members = _MemberIndex(
+            self._server_name,
+            int(config.get("max_tracked_rooms", 100000)),
+            float(config.get("room_idle_seconds", 86400)),
+        )
+
+        tracked_rooms.labels("federated").set_function(
+            lambda: self._members.federated)
+        tracked_rooms.labels("local").set_function(
+            lambda: len(self._members) - self._members.federated)
+        federated_room_ratio.set_function(self._members.federated_ratio)
+        state_bytes.labels("member_index").set_function(self._members.approx_bytes)
+
+        self._event_types = frozenset(
+            config.get("event_types", _HANDLED_EVENT_TYPES))
+        self._sample_rates = {
+            event_type: float(rate)
+            for event_type, rate in config.get("sample_rates", {}).items()
+        }
+        self._rate_limiter = None
+        if int(config.get("room_log_rate_limit", 0)) > 0:
+            self._rate_limiter = _RoomRateLimiter(
+                int(config["room_log_rate_limit"]),
+                int(config.get("max_tracked_rooms", 100000)),
+            )
+            state_bytes.labels("log_rate_limiter").set_function(
+                self._rate_limiter.approx_bytes)
+
+        self._federation = None
+        if config.get("federation_stats", True):
+            idle_seconds = float(config.get("server_idle_seconds", 86400))
+            self._federation = _FederationStats(
+                int(config.get("max_tracked_servers", 1000)), idle_seconds)
+            _federation_collector.stats = self._federation
+            state_bytes.labels("federation_stats").set_function(
+                self._federation.approx_bytes)
+            # Peers that went quiet are otherwise only evicted by the next
+            # remote event
+            api.looping_background_call(
+                self._expire_federation,
+                max(1, min(idle_seconds, 60)) * 1000,
+                desc="beacon_monitor_expire_servers",
+                run_on_all_instances=True,
+            )
+            api.register_web_resource(
+                path="/_synapse/client/beacon/federation",
+                resource=FederationStatsResource(api, self._federation),
+            )
+
+        self._pairings = None
+        if config.get("pairing_tracking", True):
+            timeout_seconds = float(config.get("pairing_timeout_seconds", 600))
+            self._pairings = _PairingTracker(
+                int(config.get("max_pairing_sessions", 100000)),
+                int(timeout_seconds * 1000),
+            )
+            api.looping_background_call(
+                self._expire_pairings,
+                max(1, min(timeout_seconds, 60)) * 1000,
+                desc="beacon_monitor_expire_pairings",
+                run_on_all_instances=True,
+            )
+            state_bytes.labels("pairings").set_function(self._pairings.approx_bytes)
+
+        self._traffic = None
+        if config.get("traffic_tracking", True):
+            self._traffic = _TrafficTracker(
+                int(config.get("traffic_top_n", 20)),
+                float(config.get("traffic_window_seconds", 300)),
+            )
+            _traffic_collector.tracker = self._traffic
+            state_bytes.labels("traffic").set_function(self._traffic.approx_bytes)
+            api.register_web_resource(
+                path="/_synapse/client/beacon/traffic",
+                resource=TrafficStatsResource(api, self._traffic),
+            )
+
+        self._logins = None
+        if config.get("login_stats", True):
+            self._logins = _LoginTracker(
+                float(config.get("login_window_seconds", 300)),
+                int(config.get("login_known_users", 100000)),
+            )
+            _login_collector.tracker = self._logins
+            state_bytes.labels("logins").set_function(self._logins.approx_bytes)
+
+        self._offload_queue: deque[_EventRecord] | None = None
+        if config.get("offload", False):
+            self._offload_queue = deque()
+            self._offload_queue_size = int(config.get("offload_queue_size", 10000))
+            self._offload_batch_size = int(config.get("offload_batch_size", 500))
+            self._drain_scheduled = False
+            self._offload_seq = itertools.count(1)
+            offload_queue_depth.set_function(lambda: len(self._offload_queue))
+        # room_id -> seq of the newest dropped membership record. The room
+        # is recounted by the first membership record queued after it.
+        self._stale_rooms: OrderedDict[str, int] = OrderedDict()
+        self._max_stale_rooms = int(config.get("max_tracked_rooms", 100000))
+
+        self._log = log.log
+        if not config.get("log_events", True):
+            self._log = _discard
+        elif config.get("async_logging", False):
+            pipeline = _LogPipeline(
+                log,
+                int(config.get("log_buffer_size", 10000)),
+                config.get("log_drop_policy", "oldest"),
+                float(config.get("log_flush_interval_ms", 100)) / 1000,
+            )
+            reactor.addSystemEventTrigger("after", "shutdown", pipeline.stop)
+            self._log = pipeline.log
 
         api.register_third_party_rules_callbacks(
             on_new_event=self._on_new_event,
@@ -50,20 +1193,74 @@ class BeaconMonitorModule:
 
         log.info("event=INIT server=%s", self._server_name)
 
+    def _event_log(self, event_type: str, room_id: str):
+        """The log sink for one event: _discard if the event's room is
+        sampled out or over its log rate limit."""
+        if self._log is _discard:
+            return _discard
+        rate = self._sample_rates.get(event_type)
+        if rate is not None and not _room_sampled(room_id, rate):
+            return _discard
+        if self._rate_limiter is not None and not self._rate_limiter.allow(room_id):
+            return _discard
+        return self._log
+
+    def _expire_federation(self) -> None:
+        self._federation.expire(int(time.time()))
+
+    def _expire_pairings(self) -> None:
+        for room_id, session in self._pairings.expire(int(time.time() * 1000)):
+            pairings_incomplete.labels(session.stage, "timeout").inc()
+            self._log(
+                logging.INFO,
+                "event=PAIRING_INCOMPLETE room=%s creator=%s stage=%s "
+                "created_ts=%d",
+                room_id,
+                session.creator,
+                session.stage,
+                session.created_ms,
+            )
+
     def _origin(self, user_id: str) -> str:
         """Return 'local' if the user belongs to this server, 'remote' otherwise."""
         return "local" if _user_server(user_id) == self._server_name else "remote"
 
+    def _complete_pairing(self, room_id: str, now_ms: int) -> None:
+        session = self._pairings.on_message(room_id, now_ms)
+        if session is None:
+            return
+        create_to_join_ms = session.joined_ms - session.created_ms
+        join_to_message_ms = now_ms - session.joined_ms
+        pairings_completed.inc()
+        pairing_seconds.labels("create_to_join").observe(create_to_join_ms / 1000)
+        pairing_seconds.labels("join_to_first_message").observe(
+            join_to_message_ms / 1000)
+        self._log(
+            logging.INFO,
+            "event=PAIRING room=%s creator=%s create_to_join_ms=%d "
+            "join_to_message_ms=%d total_ms=%d",
+            room_id,
+            session.creator,
+            create_to_join_ms,
+            join_to_message_ms,
+            now_ms - session.created_ms,
+        )
+
     async def _on_user_login(
         self,
         user_id: str,
         auth_provider_type: str | None,
         auth_provider_id: str | None,
     ) -> None:
-        log.info(
+        origin = self._origin(user_id)
+        logins.labels(origin, auth_provider_type or "none").inc()
+        if self._logins is not None:
+            self._logins.record(user_id, origin)
+        self._log(
+            logging.INFO,
             "event=LOGIN user=%s origin=%s provider_type=%s provider_id=%s",
             user_id,
-            self._origin(user_id),
+            origin,
             auth_provider_type,
             auth_provider_id,
         )
@@ -73,78 +1270,159 @@ class BeaconMonitorModule:
         event: EventBase,
         state_events: StateMap[EventBase],
     ) -> None:
-        if event.type == "m.room.member":
-            membership = event.content.get("membership", "unknown")
-            target_user = event.state_key or "unknown"
-
-            # Count local vs remote members currently in the room
-            local_members = 0
-            remote_members = 0
-            for (etype, skey), state_event in state_events.items():
-                if etype != "m.room.member":
-                    continue
-                if state_event.content.get("membership") != "join":
-                    continue
-                if _user_server(skey) == self._server_name:
-                    local_members += 1
-                else:
-                    remote_members += 1
+        if event.type not in self._event_types:
+            return
+        record = _EventRecord(event, state_events)
+        if self._offload_queue is None:
+            self._process(record)
+        else:
+            self._enqueue(record)
+
+    def _enqueue(self, record: _EventRecord) -> None:
+        """Queue a record for the drain loop, so the callback returns at once."""
+        record.seq = next(self._offload_seq)
+        if len(self._offload_queue) >= self._offload_queue_size:
+            offload_dropped.inc()
+            if record.type == "m.room.member":
+                self._mark_stale(record.room_id, record.seq)
+            return
+        self._offload_queue.append(record)
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            reactor.callLater(0, self._drain)
+
+    def _mark_stale(self, room_id: str, seq: int) -> None:
+        """Note a dropped membership change, so the room's counts are rebuilt.
+
+        Forgetting the room now would not help: records queued before the
+        drop would recreate it from their older state.
+        """
+        stale = self._stale_rooms
+        stale[room_id] = seq
+        stale.move_to_end(room_id)
+        if len(stale) > self._max_stale_rooms:
+            # Out of room for marks: drop the index entry instead, which is
+            # right unless older records for that room are still queued
+            oldest, _seq = stale.popitem(last=False)
+            self._members.forget(oldest)
+
+    def _drain(self) -> None:
+        queue = self._offload_queue
+        now_ms = int(time.time() * 1000)
+        for _ in range(min(len(queue), self._offload_batch_size)):
+            record = queue.popleft()
+            offload_lag_seconds.observe(max(now_ms - record.arrival_ms, 0) / 1000)
+            try:
+                self._process(record)
+            except Exception:
+                log.exception(
+                    "event=MONITOR_ERROR room=%s type=%s",
+                    record.room_id, record.type)
+        if queue:
+            # Yield to the reactor between batches
+            reactor.callLater(0, self._drain)
+        else:
+            self._drain_scheduled = False
+
+    def _process(self, record: _EventRecord) -> None:
+        room_id = record.room_id
+        sender = record.sender
+        event_log = self._event_log(record.type, room_id)
+
+        sender_origin = self._origin(sender)
+        age_ms = record.age_ms
+        event_age_seconds.labels(sender_origin).observe(max(age_ms, 0) / 1000)
+        if sender_origin == "remote" and self._federation is not None:
+            self._federation.record(sys.intern(_user_server(sender)), age_ms)
+
+        if record.type == "m.room.member":
+            membership = record.membership
+            target_user = record.state_key
+            user_origin = self._origin(target_user)
+            membership_transitions.labels(membership, user_origin).inc()
+
+            if self._pairings is not None:
+                self._pairings.on_membership(
+                    room_id, target_user, membership, record.arrival_ms)
+
+            if self._stale_rooms:
+                dropped_seq = self._stale_rooms.get(room_id)
+                if dropped_seq is not None and record.seq > dropped_seq:
+                    # This record's state includes the dropped change
+                    del self._stale_rooms[room_id]
+                    self._members.forget(room_id)
+            room = self._members.update(
+                room_id, target_user, membership, record.state_events)
+            local_members = room.local
+            remote_members = room.remote
 
             room_type = "local" if remote_members == 0 else "federated"
 
-            log.info(
+            event_log(
+                logging.INFO,
                 "event=MEMBERSHIP room=%s user=%s membership=%s sender=%s "
                 "user_origin=%s sender_origin=%s "
                 "room_type=%s local_members=%d remote_members=%d "
                 "event_ts=%d age_ms=%d",
-                event.room_id,
+                room_id,
                 target_user,
                 membership,
-                event.sender,
-                self._origin(target_user),
-                self._origin(event.sender),
+                sender,
+                user_origin,
+                sender_origin,
                 room_type,
                 local_members,
                 remote_members,
-                event.origin_server_ts,
-                _event_age_ms(event),
+                record.origin_server_ts,
+                age_ms,
             )
 
-        elif event.type == "m.room.create":
-            log.info(
+        elif record.type == "m.room.create":
+            rooms_created.labels(sender_origin).inc()
+            if self._pairings is not None:
+                self._pairings.on_create(room_id, sender, record.arrival_ms)
+            event_log(
+                logging.INFO,
                 "event=ROOM_CREATED room=%s creator=%s origin=%s "
                 "event_ts=%d age_ms=%d",
-                event.room_id,
-                event.sender,
-                self._origin(event.sender),
-                event.origin_server_ts,
-                _event_age_ms(event),
+                room_id,
+                sender,
+                sender_origin,
+                record.origin_server_ts,
+                age_ms,
             )
 
-        elif event.type == "m.room.message":
-            body = event.content.get("body", "")
-            log.info(
+        elif record.type == "m.room.message":
+            body_bytes = record.body_bytes
+            message_body_bytes.labels(sender_origin).observe(body_bytes)
+            if self._traffic is not None:
+                self._traffic.record(room_id, sender, body_bytes)
+            if self._pairings is not None:
+                self._complete_pairing(room_id, record.arrival_ms)
+            event_log(
+                logging.INFO,
                 "event=MESSAGE room=%s sender=%s origin=%s msgtype=%s "
                 "body_bytes=%d event_ts=%d age_ms=%d",
-                event.room_id,
-                event.sender,
-                self._origin(event.sender),
-                event.content.get("msgtype", "unknown"),
-                len(body.encode("utf-8")) if isinstance(body, str) else 0,
-                event.origin_server_ts,
-                _event_age_ms(event),
+                room_id,
+                sender,
+                sender_origin,
+                record.detail,
+                body_bytes,
+                record.origin_server_ts,
+                age_ms,
             )
 
-        elif event.type == "m.room.encryption":
-            log.info(
+        elif record.type == "m.room.encryption":
+            event_log(
+                logging.INFO,
                 "event=ENCRYPTION_ENABLED room=%s sender=%s origin=%s algorithm=%s "
                 "event_ts=%d age_ms=%d",
-                event.room_id,
-                event.sender,
-                self._origin(event.sender),
-                event.content.get("algorithm", "unknown"),
-                event.origin_server_ts,
-                _event_age_ms(event),
+                room_id,
+                sender,
+                sender_origin,
+                record.detail,
+                record.origin_server_ts,
+                age_ms,
             )
 
     @staticmethod
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-only
+# © ECAD Infra Inc.
+#
+# Microbenchmark for CryptoAuthProvider.check_password.
+#
+# Drives the provider with a fake account handler (no homeserver, no
+# database) and synthetic Ed25519 keypairs, and prints one JSON document
+# with logins/second and p50/p99 latency per scenario:
+#
+#   cold       every login is a new key: verification + registration
+#   repeat     a small set of keys logging in again and again
+#   skewed     clients signing the previous/next window
+#   malformed  scanner-style garbage credentials
+#   race       concurrent first logins for the same users
+#
+# Needs the same Python environment as the module (PyNaCl, Twisted and
+# Synapse), e.g. inside the image:
+#
+#   docker run --rm -v "$PWD:/src" -w /src --entrypoint python3 \
+#       ghcr.io/ecadinfra/beacon-synapse bench_crypto_auth.py > bench_output.txt
+#
+# Provider options can be passed as JSON to compare modes:
+#
+#   python3 bench_crypto_auth.py --config '{"verify_in_thread": true}'
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+import nacl.encoding
+import nacl.hash
+import nacl.signing
+
+import crypto_auth_provider
+from crypto_auth_provider import WINDOW_SECONDS, CryptoAuthProvider
+
+SERVER_NAME = "bench.local"
+
+
+class FakeAccountHandler:
+    """Stands in for Synapse's account handler with an optional DB delay."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.users = set()
+        self.exists_calls = 0
+        self.register_calls = 0
+
+    def _later(self, func):
+        if not self.latency:
+            return defer.maybeDeferred(func)
+        return task.deferLater(reactor, self.latency, func)
+
+    def check_user_exists(self, user_id):
+        self.exists_calls += 1
+        return self._later(lambda: user_id if user_id in self.users else None)
+
+    def register(self, localpart):
+        self.register_calls += 1
+        user_id = "@{}:{}".format(localpart, SERVER_NAME)
+
+        def _register():
+            if user_id in self.users:
+                raise Exception("User ID already taken")
+            self.users.add(user_id)
+            return user_id
+
+        return self._later(_register)
+
+
+def _credentials(signing_key, window_offset: int = 0):
+    public_key = signing_key.verify_key.encode()
+    window = int(time.time() / WINDOW_SECONDS) + window_offset
+    digest = nacl.hash.blake2b(
+        "login:{}".format(window).encode(),
+        digest_size=32, encoder=nacl.encoding.RawEncoder)
+    signature = signing_key.sign(digest).signature
+    localpart = nacl.hash.blake2b(
+        public_key, digest_size=32, encoder=nacl.encoding.RawEncoder).hex()
+    user_id = "@{}:{}".format(localpart, SERVER_NAME)
+    return user_id, "ed:{}:{}".format(signature.hex(), public_key.hex())
+
+
+def _keys(count: int):
+    return [nacl.signing.SigningKey.generate() for _ in range(count)]
+
+
+def _percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+@defer.inlineCallbacks
+def _timed(provider, user_id, password, latencies):
+    start = time.perf_counter()
+    ok = yield provider.check_password(user_id, password)
+    latencies.append(time.perf_counter() - start)
+    return ok
+
+
+@defer.inlineCallbacks
+def _run(name, config, logins, concurrent=False, latency=0.0):
+    """Time check_password over (user_id, password) pairs."""
+    provider = CryptoAuthProvider(config, FakeAccountHandler(latency))
+    latencies = []
+    start = time.perf_counter()
+    if concurrent:
+        results = yield defer.gatherResults(
+            [_timed(provider, u, p, latencies) for u, p in logins],
+            consumeErrors=True)
+    else:
+        results = []
+        for user_id, password in logins:
+            results.append((yield _timed(provider, user_id, password, latencies)))
+    elapsed = time.perf_counter() - start
+
+    handler = provider.account_handler
+    return {
+        "scenario": name,
+        "logins": len(logins),
+        "accepted": sum(1 for ok in results if ok),
+        "seconds": round(elapsed, 6),
+        "logins_per_second": round(len(logins) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 4),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 4),
+        "check_user_exists_calls": handler.exists_calls,
+        "register_calls": handler.register_calls,
+    }
+
+
+@defer.inlineCallbacks
+def main(_reactor, args):
+    config = json.loads(args.config)
+    n = args.iterations
+
+    cold = [_credentials(key) for key in _keys(n)]
+    repeat_keys = [_credentials(key) for key in _keys(max(1, n // 100))]
+    repeat = [repeat_keys[i % len(repeat_keys)] for i in range(n)]
+    skewed = [_credentials(key, (-1, 1)[i % 2]) for i, key in enumerate(_keys(n))]
+    malformed = [
+        ("@{}:{}".format("ab" * (i % 40), SERVER_NAME), garbage)
+        for i, garbage in enumerate(
+            ["", "ed:", "ed:zz:zz", "ed:" + "00" * 64, "x" * 512] * (n // 5 + 1))
+    ][:n]
+    race_users = [_credentials(key) for key in _keys(max(1, n // 10))]
+    race = [pair for pair in race_users for _ in range(10)][:n]
+
+    scenarios = []
+    scenarios.append((yield _run("cold", config, cold)))
+    scenarios.append((yield _run("repeat", config, repeat)))
+    scenarios.append((yield _run("skewed", config, skewed)))
+    scenarios.append((yield _run("malformed", config, malformed)))
+    scenarios.append((yield _run(
+        "race", config, race, concurrent=True, latency=args.db_latency_ms / 1000)))
+
+    json.dump({
+        "provider_version": crypto_auth_provider.__version__,
+        "python": platform.python_version(),
+        "iterations": n,
+        "config": config,
+        "scenarios": scenarios,
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark CryptoAuthProvider.check_password")
+    parser.add_argument("--iterations", "-n", type=int, default=2000,
+                        help="logins per scenario (default: 2000)")
+    parser.add_argument("--config", default="{}",
+                        help="provider config as JSON (default: {})")
+    parser.add_argument("--db-latency-ms", type=float, default=1.0,
+                        help="simulated account handler latency in the race "
+                             "scenario (default: 1.0)")
+    parser.add_argument("--log", action="store_true",
+                        help="keep the provider's INFO/WARNING log lines")
+    args = parser.parse_args()
+    if not args.log:
+        logging.getLogger("crypto_auth_provider").setLevel(logging.ERROR)
+    task.react(main, [args])
@@ -19,19 +19,364 @@
 #     - module: 'crypto_auth_provider.CryptoAuthProvider'
 #       config:
 #         enabled: true
+#         verified_cache_size: 10000   # 0 disables the verified-signature cache
+#         verify_in_thread: false      # verify signatures off the reactor thread
+#         verify_threads: 4
+#         batch_verify: false          # coalesce and batch concurrent logins
+#         batch_max_size: 64
+#         batch_delay_ms: 2
+#         known_users_cache_size: 100000  # users known to exist, skips DB lookups
+#         known_users_cache_ttl: 0         # seconds, 0 keeps entries until evicted
+#         failed_cache_size: 10000         # known-bad credentials rejected cheaply
+#         failed_cache_ttl: 60             # 0 disables the failed cache
+#         pubkey_failure_threshold: 0      # 0 disables per-key early rejects
+#         pubkey_failure_window: 300       # seconds, 0 disables per-key early rejects
+#         pubkey_failure_cache_size: 10000
 
+import hashlib
+import hmac
 import logging
 import time
+from collections import OrderedDict
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 import nacl.encoding
 import nacl.exceptions
 import nacl.hash
 import nacl.signing
+from prometheus_client import Counter, Gauge, Histogram
+from synapse.logging.context import PreserveLoggingContext, make_deferred_yieldable
 
 __version__ = "0.3"
 logger = logging.getLogger(__name__)
 
+# Also served by /_synapse/client/beacon/time (beacon_info_module); keep in sync
+WINDOW_SECONDS = 5 * 60
+_WINDOW_LABELS = {0: "current", -1: "previous", 1: "next"}
+
+# Hex lengths of a BLAKE2b-256 localpart, an Ed25519 signature and public key
+_LOCALPART_HEX_LEN = 64
+_SIGNATURE_HEX_LEN = 128
+_PUBLIC_KEY_HEX_LEN = 64
+
+# Registered on the default registry, so they are served by Synapse's
+# metrics listeners (19090 on main, 19091+ on workers).
+_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+auth_attempts = Counter(
+    "beacon_auth_attempts_total",
+    "Login attempts handled by the Ed25519 provider",
+    ["outcome", "reason"])
+verify_seconds = Histogram(
+    "beacon_auth_verify_seconds",
+    "Time to verify a login signature, including any queueing",
+    buckets=_LATENCY_BUCKETS)
+window_matches = Counter(
+    "beacon_auth_window_matches_total",
+    "Verified signatures by the time window they covered",
+    ["window"])
+cache_lookups = Counter(
+    "beacon_auth_cache_lookups_total",
+    "Auth provider cache lookups",
+    ["cache", "result"])
+registration_races = Counter(
+    "beacon_auth_registration_races_total",
+    "First-login registrations that lost a race to another worker")
+account_handler_seconds = Histogram(
+    "beacon_auth_account_handler_seconds",
+    "Time spent in account handler calls",
+    ["call"],
+    buckets=_LATENCY_BUCKETS)
+verify_pool_pending = Gauge(
+    "beacon_auth_verify_pool_pending",
+    "Verification jobs submitted to the thread pool and not yet finished")
+verify_pool_wait_seconds = Histogram(
+    "beacon_auth_verify_pool_wait_seconds",
+    "Time verification jobs wait for a pool thread",
+    buckets=_LATENCY_BUCKETS)
+verify_batch_size = Histogram(
+    "beacon_auth_verify_batch_size",
+    "Verifications per batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+verify_coalesced = Counter(
+    "beacon_auth_verify_coalesced_total",
+    "Verifications answered by an identical request already queued or running")
+
+
+class _LRUCache:
+    """Bounded LRU mapping whose entries may carry a wall-clock expiry."""
+
+    def __init__(self, name: str, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._hit_counter = cache_lookups.labels(name, "hit")
+        self._miss_counter = cache_lookups.labels(name, "miss")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            self._miss_counter.inc()
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            self._miss_counter.inc()
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self._hit_counter.inc()
+        return value
+
+    def set(self, key, value, expires_at: float | None = None):
+        if self.max_size <= 0:
+            return
+        if expires_at is None and self.ttl:
+            expires_at = time.time() + self.ttl
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def increment(self, key) -> int:
+        """Add one to a counter entry and restart its expiry.
+
+        Reads the entry directly so the bump is not counted as a lookup.
+        """
+        entry = self._entries.get(key)
+        count = 1
+        if entry is not None and (entry[1] is None or entry[1] > time.time()):
+            count = entry[0] + 1
+        self.set(key, count)
+        return count
+
+
+def _parse_credentials(user_id: str, password: str):
+    """Split ``@<localpart>:<server>`` and ``ed:<sig>:<pk>``.
+
+    Lengths are checked before any hex is decoded, so the garbage that
+    scanners send is rejected without allocating. The ``ed`` prefix itself
+    is not checked, as before. Raises ValueError if malformed.
+    """
+    localpart, sep, _server = user_id.partition(":")
+    if not sep or len(localpart) != _LOCALPART_HEX_LEN + 1:
+        raise ValueError("bad user_id length")
+    parts = password.split(":", 2)
+    if (len(parts) != 3
+            or len(parts[1]) != _SIGNATURE_HEX_LEN
+            or len(parts[2]) != _PUBLIC_KEY_HEX_LEN):
+        raise ValueError("bad password format")
+    localpart = localpart[1:].lower()
+    return (
+        localpart,
+        bytes.fromhex(localpart),
+        bytes.fromhex(parts[1]),
+        bytes.fromhex(parts[2]),
+    )
+
+
+def _challenge_digest(window: int) -> bytes:
+    return nacl.hash.blake2b(
+        "login:{}".format(window).encode(),
+        digest_size=32, encoder=nacl.encoding.RawEncoder)
+
+
+class _ChallengeDigests:
+    """Login challenge digests for the windows around the current one.
+
+    The digests are the same for every user, so they are computed once per
+    window rotation, by a reactor timer at the window boundary rather than
+    by the first login after it. The window after next is hashed ahead of
+    time too. If a login gets in before the timer (a busy reactor), get()
+    rotates the table itself, which hashes one window.
+    """
+
+    def __init__(self):
+        self._window = None
+        self._digests = {}
+        self._timer = None
+        self._rotate()
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def get(self, window: int) -> dict[int, bytes]:
+        if window != self._window:
+            previous = self._digests
+            # Swap in a complete table so readers never see a partial one
+            self._digests = {
+                w: previous.get(w) or _challenge_digest(w)
+                for w in range(window - 1, window + 3)
+            }
+            self._window = window
+        return self._digests
+
+    def stop(self) -> None:
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _rotate(self) -> None:
+        now = time.time()
+        window = int(now / WINDOW_SECONDS)
+        self.get(window)
+        self._timer = reactor.callLater(
+            (window + 1) * WINDOW_SECONDS - now, self._rotate)
+
+
+def _window_offsets(now: float, skew_margin: float) -> tuple[int, ...]:
+    """Order in which to try the accepted windows, most likely match first.
+
+    A client whose clock is slightly behind still signs the previous window
+    just after a rotation; one slightly ahead signs the next window just
+    before it.
+    """
+    position = now % WINDOW_SECONDS
+    if position < skew_margin:
+        return (-1, 0, 1)
+    if position >= WINDOW_SECONDS - skew_margin:
+        return (1, 0, -1)
+    return (0, -1, 1)
+
+
+def _verify_signature(public_key: bytes, signature: bytes, candidates):
+    """Try each (offset, digest) candidate in order.
+
+    Returns (matched offset, attempts made), or None if the signature covers
+    none of the candidates.
+    """
+    try:
+        verify_key = nacl.signing.VerifyKey(public_key)
+    except (nacl.exceptions.CryptoError, ValueError, TypeError):
+        return None
+    for attempts, (offset, message_digest) in enumerate(candidates, 1):
+        try:
+            verify_key.verify(message_digest, signature)
+        except (nacl.exceptions.BadSignatureError, ValueError):
+            continue
+        return offset, attempts
+    return None
+
+
+def _verify_batch(items):
+    return [_verify_signature(*item) for item in items]
+
+
+class _VerifyPool:
+    """Dedicated, bounded thread pool for signature verification.
+
+    libsodium releases the GIL while verifying, so this keeps reconnect
+    storms from stalling the reactor. All counters are updated on the
+    reactor thread.
+    """
+
+    def __init__(self, size: int):
+        self._pool = ThreadPool(
+            minthreads=0, maxthreads=size, name="beacon-auth-verify")
+        # Submitted but not yet finished
+        self.pending = 0
+        self.completed = 0
+        # Time between submission and a worker picking the job up
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger("during", "shutdown", self._pool.stop)
+
+    @defer.inlineCallbacks
+    def run(self, func, *args):
+        self.pending += 1
+        verify_pool_pending.inc()
+        try:
+            waited, result = yield make_deferred_yieldable(
+                threads.deferToThreadPool(
+                    reactor, self._pool, _timed_call, time.monotonic(),
+                    func, *args))
+        finally:
+            self.pending -= 1
+            verify_pool_pending.dec()
+        verify_pool_wait_seconds.observe(waited)
+        self.completed += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        defer.returnValue(result)
+
+
+def _timed_call(submitted: float, func, *args):
+    waited = time.monotonic() - submitted
+    return waited, func(*args)
+
+
+class _BatchVerifier:
+    """Collects verifications for a few milliseconds, or until max_size are
+    queued, and runs them on the verify pool in a single hop.
+
+    Identical concurrent requests (same public key, signature and window)
+    share one verification, whether the first is still queued or already
+    running. This absorbs the burst of logins after a relay restart.
+    """
+
+    def __init__(self, pool: _VerifyPool, max_size: int, delay: float):
+        self._pool = pool
+        self._max_size = max(1, max_size)
+        self._delay = delay
+        # key -> Deferreds waiting on that verification (queued or running)
+        self._waiters = {}
+        self._queued = []
+        self._timer = None
+        self.batches = 0
+        self.coalesced = 0
+
+    def verify(self, public_key: bytes, signature: bytes, window: int, candidates):
+        key = (public_key, signature, window)
+        d = defer.Deferred()
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            waiters.append(d)
+            self.coalesced += 1
+            verify_coalesced.inc()
+            return make_deferred_yieldable(d)
+        self._waiters[key] = [d]
+        self._queued.append((key, (public_key, signature, candidates)))
+        if len(self._queued) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self._delay, self._flush)
+        return make_deferred_yieldable(d)
+
+    def _flush(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        batch, self._queued = self._queued, []
+        if not batch:
+            return
+        self.batches += 1
+        verify_batch_size.observe(len(batch))
+        keys = [key for key, _item in batch]
+        # The batch serves many requests, so it runs outside any one
+        # caller's logcontext; each waiter's context is restored on delivery.
+        with PreserveLoggingContext():
+            d = self._pool.run(_verify_batch, [item for _key, item in batch])
+            d.addCallbacks(
+                self._deliver, self._fail,
+                callbackArgs=(keys,), errbackArgs=(keys,))
+
+    def _deliver(self, results, keys):
+        for key, result in zip(keys, results):
+            for waiter in self._waiters.pop(key):
+                waiter.callback(result)
+
+    def _fail(self, failure, keys):
+        for key in keys:
+            for waiter in self._waiters.pop(key):
+                waiter.errback(failure)
+
 
 class CryptoAuthProvider:
     __version__ = "0.3"
@@ -40,66 +385,195 @@ class CryptoAuthProvider:
         self.account_handler = account_handler
         self.config = config
         self.log = logging.getLogger(__name__)
+        # (public_key, signature) -> time window the signature was verified for.
+        # Entries expire once that window falls outside the accepted skew.
+        self.verified_cache = _LRUCache(
+            "verified", int(config.get("verified_cache_size", 10000)))
+        self.challenge_digests = _ChallengeDigests()
+        self.skew_margin = float(config.get("skew_margin_seconds", 60))
+        self.verify_pool = None
+        self.batch_verifier = None
+        batch_verify = config.get("batch_verify", False)
+        if config.get("verify_in_thread", False) or batch_verify:
+            self.verify_pool = _VerifyPool(int(config.get("verify_threads", 4)))
+        if batch_verify:
+            self.batch_verifier = _BatchVerifier(
+                self.verify_pool,
+                int(config.get("batch_max_size", 64)),
+                float(config.get("batch_delay_ms", 2)) / 1000)
+        # Registration is permanent, so once a user is known to exist the
+        # check_user_exists round-trip can be skipped on later logins.
+        self.known_users = _LRUCache(
+            "known_users", int(config.get("known_users_cache_size", 100000)),
+            ttl=float(config.get("known_users_cache_ttl", 0)) or None)
+        # user_id -> Deferreds waiting on that user's in-flight registration
+        self._registrations = {}
+        # Digest of (user_id, password) for credentials that recently failed
+        # signature or key checks; replays are rejected without crypto work.
+        # Entries must expire, so a TTL of 0 disables the cache.
+        failed_ttl = float(config.get("failed_cache_ttl", 60))
+        self.failed_cache = _LRUCache(
+            "failed",
+            int(config.get("failed_cache_size", 10000)) if failed_ttl > 0 else 0,
+            ttl=failed_ttl)
+        # public_key -> recent signature failures. Public keys are public, so
+        # a low threshold lets anyone lock a wallet out; disabled by default.
+        self.pubkey_failure_threshold = int(
+            config.get("pubkey_failure_threshold", 0))
+        # A window of 0 disables counting rather than locking keys out for good
+        failure_window = float(config.get("pubkey_failure_window", 300))
+        self.pubkey_failures = _LRUCache(
+            "pubkey_failures",
+            int(config.get("pubkey_failure_cache_size", 10000))
+            if failure_window > 0 else 0,
+            ttl=failure_window)
 
     @defer.inlineCallbacks
     def check_password(self, user_id: str, password: str):
         try:
-            public_key_hash = bytes.fromhex(user_id.split(":", 1)[0][1:])
-            signature = bytes.fromhex(password.split(":")[1])
-            public_key = bytes.fromhex(password.split(":")[2])
-            public_key_digest = nacl.hash.blake2b(
-                public_key, digest_size=32,
-                encoder=nacl.encoding.RawEncoder)
-        except (ValueError, IndexError) as exc:
+            localpart, public_key_hash, signature, public_key = (
+                _parse_credentials(user_id, password))
+        except ValueError as exc:
             self.log.warning(
                 "event=AUTH_FAIL user=%s reason=malformed_credentials err=%s",
                 user_id, exc)
+            auth_attempts.labels("fail", "malformed_credentials").inc()
             defer.returnValue(False)
             return
 
-        if public_key_hash.hex() != public_key_digest.hex():
+        credentials_digest = hashlib.blake2b(
+            "{}\n{}".format(user_id, password).encode(),
+            digest_size=16).digest()
+        if self.failed_cache.get(credentials_digest):
+            self.log.warning(
+                "event=AUTH_FAIL user=%s reason=known_bad_credentials", user_id)
+            auth_attempts.labels("fail", "known_bad_credentials").inc()
+            defer.returnValue(False)
+            return
+
+        public_key_digest = nacl.hash.blake2b(
+            public_key, digest_size=32, encoder=nacl.encoding.RawEncoder)
+        if not hmac.compare_digest(public_key_hash, public_key_digest):
             self.log.warning(
                 "event=AUTH_FAIL user=%s reason=pubkey_mismatch", user_id)
+            auth_attempts.labels("fail", "pubkey_mismatch").inc()
+            self.failed_cache.set(credentials_digest, True)
             defer.returnValue(False)
             return
 
-        current_time_window = int(time.time() / (5 * 60))
+        now = time.time()
+        current_time_window = int(now / WINDOW_SECONDS)
+
+        # Wallets reconnect often and resend the same signed challenge, so a
+        # signature already verified for a still-acceptable window is trusted.
+        cached_window = self.verified_cache.get((public_key, signature))
+        if cached_window is not None:
+            offset = cached_window - current_time_window
+            if -1 <= offset <= 1:
+                self.log.info(
+                    "event=AUTH_OK user=%s window=%s cached=true",
+                    user_id.lower(), _WINDOW_LABELS[offset])
+                auth_attempts.labels("ok", "cached").inc()
+                yield self._ensure_registered(user_id, localpart)
+                defer.returnValue(True)
+                return
+
+        failures = self.pubkey_failures.get(public_key, 0)
+        if self.pubkey_failure_threshold and failures >= self.pubkey_failure_threshold:
+            self.log.warning(
+                "event=AUTH_FAIL user=%s reason=pubkey_throttled failures=%d",
+                user_id, failures)
+            auth_attempts.labels("fail", "pubkey_throttled").inc()
+            defer.returnValue(False)
+            return
 
         # Check current, previous (-5min), and next (+5min) time windows
-        # to handle reasonable clock skew between client and server
-        verified = False
-        for offset, label in ((0, "current"), (-1, "previous"), (1, "next")):
-            message_digest = nacl.hash.blake2b(
-                "login:{}".format(current_time_window + offset).encode(),
-                digest_size=32, encoder=nacl.encoding.RawEncoder)
-            try:
-                nacl.signing.VerifyKey(public_key).verify(
-                    message_digest, signature)
-            except nacl.exceptions.BadSignatureError:
-                continue
-            verified = True
-            self.log.info("event=AUTH_OK user=%s window=%s", user_id.lower(), label)
-            break
-
-        if not verified:
+        # to handle reasonable clock skew between client and server,
+        # starting with the one the client most likely signed
+        digests = self.challenge_digests.get(current_time_window)
+        candidates = [
+            (offset, digests[current_time_window + offset])
+            for offset in _window_offsets(now, self.skew_margin)
+        ]
+        with verify_seconds.time():
+            if self.batch_verifier is not None:
+                match = yield self.batch_verifier.verify(
+                    public_key, signature, current_time_window, candidates)
+            elif self.verify_pool is not None:
+                match = yield self.verify_pool.run(
+                    _verify_signature, public_key, signature, candidates)
+            else:
+                match = _verify_signature(public_key, signature, candidates)
+        if match is None:
             self.log.warning(
                 "event=AUTH_FAIL user=%s reason=signature_invalid", user_id)
+            auth_attempts.labels("fail", "signature_invalid").inc()
+            self.failed_cache.set(credentials_digest, True)
+            # Counted after the verification yield, so concurrent failures
+            # for the same key each add one
+            self.pubkey_failures.increment(public_key)
             defer.returnValue(False)
             return
 
-        if not (yield self.account_handler.check_user_exists(user_id)):
+        offset, attempts = match
+        label = _WINDOW_LABELS[offset]
+        window_matches.labels(label).inc()
+        self.verified_cache.set(
+            (public_key, signature), current_time_window + offset,
+            expires_at=(current_time_window + offset + 2) * WINDOW_SECONDS)
+        self.log.info(
+            "event=AUTH_OK user=%s window=%s attempts=%d",
+            user_id.lower(), label, attempts)
+        auth_attempts.labels("ok", "verified").inc()
+
+        yield self._ensure_registered(user_id, localpart)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _ensure_registered(self, user_id: str, localpart: str):
+        if self.known_users.get(user_id):
+            return
+
+        # Concurrent first logins for the same user wait on the one in flight
+        waiters = self._registrations.get(user_id)
+        if waiters is not None:
+            d = defer.Deferred()
+            waiters.append(d)
+            yield make_deferred_yieldable(d)
+            return
+
+        self._registrations[user_id] = []
+        try:
+            yield self._check_or_register(user_id, localpart)
+        except Exception:
+            # Waiters resume in their own logcontexts, not this login's
+            with PreserveLoggingContext():
+                for waiter in self._registrations.pop(user_id):
+                    waiter.errback()
+            raise
+        self.known_users.set(user_id, True)
+        with PreserveLoggingContext():
+            for waiter in self._registrations.pop(user_id):
+                waiter.callback(None)
+
+    @defer.inlineCallbacks
+    def _check_or_register(self, user_id: str, localpart: str):
+        with account_handler_seconds.labels("check_user_exists").time():
+            exists = yield self.account_handler.check_user_exists(user_id)
+        if not exists:
             self.log.info("event=REGISTER user=%s", user_id.lower())
             try:
-                yield self.account_handler.register(localpart=public_key_digest.hex())
+                with account_handler_seconds.labels("register").time():
+                    yield self.account_handler.register(localpart=localpart)
             except Exception as exc:
-                # Handle race: concurrent first-login may have registered already
+                # Handle race: a first login on another worker may have
+                # registered already
                 if (yield self.account_handler.check_user_exists(user_id)):
                     self.log.info("event=REGISTER_RACE user=%s (already registered)", user_id.lower())
+                    registration_races.inc()
                 else:
                     raise exc
 
-        defer.returnValue(True)
-
     @staticmethod
     def parse_config(config):
         return config
@@ -0,0 +1,369 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# © ECAD Infra Inc.
+#
+# Tests for the known_servers prober and /beacon/network in
+# beacon_info_module, run against stand-in relays served by twisted.web on
+# localhost.
+#
+#   python -m twisted.trial tests
+
+import json
+import time
+
+from synapse.logging.context import (
+    SENTINEL_CONTEXT,
+    LoggingContext,
+    current_context,
+    make_deferred_yieldable,
+)
+from synapse.metrics.background_process_metrics import run_as_background_process
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+from twisted.web.test.requesthelper import DummyRequest
+
+import beacon_info_module
+from beacon_info_module import (
+    BeaconInfoResource,
+    BeaconNetworkResource,
+    _fetch_json,
+    _ServerHealth,
+    _ServerProber,
+)
+
+VERSION = json.dumps({"server": {"name": "Synapse", "version": "1.148.0"}}).encode()
+
+
+class _JsonClient:
+    """Same get_json contract as Synapse's SimpleHttpClient: the decoded
+    body on a 2xx response, an exception otherwise."""
+
+    def __init__(self, pool: HTTPConnectionPool):
+        self._agent = Agent(reactor, pool=pool)
+
+    async def get_json(self, uri: str):
+        response = await self._agent.request(b"GET", uri.encode("ascii"))
+        body = await readBody(response)
+        if not 200 <= response.code < 300:
+            raise ValueError("{}: {}".format(response.code, body.decode()))
+        return json.loads(body)
+
+
+class _LogcontextClient(_JsonClient):
+    """Follows the logcontext rules like SimpleHttpClient, and records the
+    logcontext each request started in."""
+
+    def __init__(self, pool: HTTPConnectionPool):
+        super().__init__(pool)
+        self.contexts = []
+
+    async def get_json(self, uri: str):
+        self.contexts.append(current_context())
+        return await make_deferred_yieldable(
+            defer.ensureDeferred(super().get_json(uri)))
+
+
+class _Relay(Resource):
+    """Answers after delay seconds with status and body; None never answers."""
+
+    isLeaf = True
+
+    def __init__(self, delay: float | None, status: int = 200, body: bytes = VERSION):
+        super().__init__()
+        self.delay = delay
+        self.status = status
+        self.body = body
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._calls = []
+
+    def render_GET(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.delay is None:
+            request.notifyFinish().addErrback(lambda _: self._done())
+            return NOT_DONE_YET
+        self._calls.append(reactor.callLater(self.delay, self._respond, request))
+        return NOT_DONE_YET
+
+    def _respond(self, request):
+        self._done()
+        request.setResponseCode(self.status)
+        request.write(self.body)
+        request.finish()
+
+    def _done(self):
+        self.in_flight -= 1
+
+    def cancel_pending(self):
+        for call in self._calls:
+            if call.active():
+                call.cancel()
+
+
+class ProberTestCase(unittest.TestCase):
+    def setUp(self):
+        self.relays = {
+            "fast": _Relay(0.0),
+            "slow": _Relay(0.15),
+            "hang": _Relay(None),
+            "error": _Relay(0.0, status=500, body=b'{"errcode": "M_UNKNOWN"}'),
+            "notjson": _Relay(0.0, body=b"<html>"),
+        }
+        root = Resource()
+        for name, relay in self.relays.items():
+            root.putChild(name.encode(), relay)
+            self.addCleanup(relay.cancel_pending)
+        self.port = reactor.listenTCP(0, Site(root), interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.addCleanup(self.pool.closeCachedConnections)
+        self.client = _JsonClient(self.pool)
+
+    def server(self, name: str) -> str:
+        return "http://127.0.0.1:{}/{}".format(self.port.getHost().port, name)
+
+    def prober(self, servers, concurrency=4, timeout=0.5):
+        self.updates = []
+        return _ServerProber(
+            self.client, servers, "", timeout, concurrency, self.updates.append)
+
+    @defer.inlineCallbacks
+    def test_fetch_json(self):
+        rtt, body = yield _fetch_json(self.client, self.server("slow"), 1)
+        self.assertEqual(body["server"]["name"], "Synapse")
+        self.assertGreaterEqual(rtt, 0.15)
+
+    @defer.inlineCallbacks
+    def test_fetch_json_timeout(self):
+        with self.assertRaises(TimeoutError):
+            yield _fetch_json(self.client, self.server("hang"), 0.1)
+
+    @defer.inlineCallbacks
+    def test_fetch_json_failures(self):
+        for url in (self.server("error"), self.server("notjson"), "http://127.0.0.1:1/"):
+            with self.assertRaises(Exception):
+                yield _fetch_json(self.client, url, 1)
+
+    @defer.inlineCallbacks
+    def test_round_ranks_servers(self):
+        servers = [
+            "http://127.0.0.1:1",
+            self.server("hang"),
+            self.server("slow"),
+            self.server("error"),
+            self.server("fast"),
+        ]
+        prober = self.prober(servers, timeout=0.3)
+        yield defer.ensureDeferred(prober.probe_all())
+
+        ranked = self.updates[-1]
+        self.assertEqual(
+            [h.server for h in ranked[:2]], [self.server("fast"), self.server("slow")])
+        self.assertTrue(all(h.available for h in ranked[:2]))
+        self.assertLess(ranked[0].rtt_ms, ranked[1].rtt_ms)
+        # Down servers keep their configured order
+        self.assertEqual(
+            [h.server for h in ranked[2:]],
+            ["http://127.0.0.1:1", self.server("hang"), self.server("error")])
+        for health in ranked[2:]:
+            self.assertIs(health.available, False)
+            self.assertIsNone(health.rtt_ms)
+            self.assertIsNotNone(health.last_probe)
+        self.assertIn("no response within", ranked[3].error)
+
+    @defer.inlineCallbacks
+    def test_round_keeps_logcontext(self):
+        client = _LogcontextClient(self.pool)
+        servers = [self.server("fast"), self.server("slow"), self.server("error")]
+        prober = _ServerProber(client, servers, "", 0.5, 2, lambda ranked: None)
+
+        async def run_round():
+            with LoggingContext(name="probe", server_name="test") as context:
+                await prober.probe_all()
+                self.assertIs(current_context(), context)
+            return context
+
+        context = yield defer.ensureDeferred(run_round())
+        self.assertIs(current_context(), SENTINEL_CONTEXT)
+        self.assertEqual(client.contexts, [context] * 3)
+
+    @defer.inlineCallbacks
+    def test_recovery(self):
+        prober = self.prober([self.server("error")])
+        yield defer.ensureDeferred(prober.probe_all())
+        self.assertIs(self.updates[-1][0].available, False)
+        self.relays["error"].status = 200
+        self.relays["error"].body = VERSION
+        yield defer.ensureDeferred(prober.probe_all())
+        self.assertIs(self.updates[-1][0].available, True)
+
+    @defer.inlineCallbacks
+    def test_concurrency_is_bounded(self):
+        prober = self.prober([self.server("slow")] * 6, concurrency=2)
+        yield defer.ensureDeferred(prober.probe_all())
+        self.assertEqual(self.relays["slow"].max_in_flight, 2)
+        self.assertTrue(all(h.available for h in self.updates[-1]))
+
+    @defer.inlineCallbacks
+    def test_info_lists_ranked_servers(self):
+        servers = [self.server("error"), self.server("slow"), self.server("fast")]
+        resource = BeaconInfoResource({"known_servers": servers})
+        prober = self.prober(servers)
+        prober._on_update = resource.set_servers
+        yield defer.ensureDeferred(prober.probe_all())
+
+        class Request:
+            def setHeader(self, name, value):
+                pass
+
+        body = json.loads(resource.render_GET(Request()))
+        self.assertEqual(
+            body["known_servers"],
+            [self.server("fast"), self.server("slow"), self.server("error")])
+        self.assertEqual(
+            [s["available"] for s in body["servers"]], [True, True, False])
+
+
+class RankTestCase(unittest.TestCase):
+    def test_rank_order(self):
+        up_slow = _ServerHealth("a", 0)
+        up_slow.available, up_slow.rtt_ms = True, 80.0
+        down = _ServerHealth("b", 1)
+        down.available = False
+        unprobed = _ServerHealth("c", 2)
+        up_fast = _ServerHealth("d", 3)
+        up_fast.available, up_fast.rtt_ms = True, 20.0
+        ranked = sorted([up_slow, down, unprobed, up_fast], key=_ServerHealth.rank)
+        self.assertEqual([h.server for h in ranked], ["d", "a", "c", "b"])
+
+    def test_server_url(self):
+        self.assertEqual(
+            beacon_info_module._server_url("relay.example.com", "/x"),
+            "https://relay.example.com/x")
+        self.assertEqual(
+            beacon_info_module._server_url("http://127.0.0.1:8008/", "/x"),
+            "http://127.0.0.1:8008/x")
+
+
+class _PendingClient:
+    """get_json answers from a queue of Deferreds the test fires by hand,
+    following the logcontext rules."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def get_json(self, uri: str):
+        d = defer.Deferred()
+        self.calls.append((uri, d))
+        return await make_deferred_yieldable(d)
+
+
+class _FailingClient:
+    """Fails every request before it goes anywhere."""
+
+    async def get_json(self, uri: str):
+        raise ValueError("bad host")
+
+
+class _Api:
+    """The parts of ModuleApi that BeaconNetworkResource uses."""
+
+    def __init__(self, http_client):
+        self.http_client = http_client
+
+    def run_as_background_process(self, desc, func, *args):
+        return run_as_background_process(desc, "test", func, *args)
+
+
+class _ContextRequest(DummyRequest):
+    """Records the logcontext the request was finished in."""
+
+    finished_in = None
+
+    def finish(self):
+        self.finished_in = current_context()
+        super().finish()
+
+
+class NetworkTestCase(unittest.TestCase):
+    def network(self, client, servers, cache_seconds=30, stale_seconds=60):
+        return BeaconNetworkResource(
+            _Api(client), servers, 1, 4, cache_seconds, stale_seconds)
+
+    def test_no_servers(self):
+        body = self.network(_FailingClient(), []).render_GET(DummyRequest([]))
+        self.assertEqual(json.loads(body)["total"], 0)
+
+    def test_synchronous_failure(self):
+        # Every fetch fails before render_GET returns; the first request
+        # must still be answered
+        request = DummyRequest([])
+        body = self.network(_FailingClient(), ["relay.example.com"]).render_GET(request)
+        body = json.loads(body)
+        self.assertEqual((body["reachable"], body["total"]), (0, 1))
+        self.assertIn("bad host", body["servers"][0]["error"])
+
+    def test_waiters_share_one_fan_out(self):
+        client = _PendingClient()
+        network = self.network(client, ["relay.example.com"])
+        first, second, gone = DummyRequest([]), DummyRequest([]), DummyRequest([])
+        for request in (first, second, gone):
+            self.assertEqual(network.render_GET(request), NOT_DONE_YET)
+        self.assertEqual(len(client.calls), 1)
+        gone.processingFailed(Failure(ConnectionError("client went away")))
+
+        client.calls[0][1].callback({"timestamp": time.time(), "region": "eu"})
+        for request in (first, second):
+            self.assertEqual(request.finished, 1)
+            body = json.loads(b"".join(request.written))
+            self.assertEqual(body["servers"][0]["region"], "eu")
+        self.assertEqual((gone.finished, gone.written), (0, []))
+
+        # Served from the cache from now on
+        self.assertNotEqual(network.render_GET(DummyRequest([])), NOT_DONE_YET)
+        self.assertEqual(len(client.calls), 1)
+
+    def test_fan_out_keeps_logcontext(self):
+        client = _PendingClient()
+        network = self.network(client, ["relay.example.com"])
+        request = _ContextRequest([])
+        with LoggingContext(name="req1", server_name="test") as context:
+            self.assertEqual(network.render_GET(request), NOT_DONE_YET)
+            self.assertIs(current_context(), context)
+
+        client.calls[0][1].callback({"timestamp": time.time()})
+        self.assertEqual(request.finished, 1)
+        self.assertIs(request.finished_in, SENTINEL_CONTEXT)
+        self.assertIs(current_context(), SENTINEL_CONTEXT)
+
+    def test_skew_with_granularity(self):
+        client = _PendingClient()
+        network = self.network(client, ["relay.example.com"])
+        request = DummyRequest([])
+        network.render_GET(request)
+        # A peer in step with us, reporting the start of a 10s step
+        now = time.time()
+        client.calls[0][1].callback(
+            {"timestamp": now - now % 10, "timestamp_granularity": 10})
+        server = json.loads(b"".join(request.written))["servers"][0]
+        self.assertEqual(server["skew_error_ms"], 5000)
+        self.assertLessEqual(abs(server["skew_ms"]), server["skew_error_ms"] + 100)
+
+    def test_info_advertises_granularity(self):
+        class Request:
+            def setHeader(self, name, value):
+                pass
+
+            def getHeader(self, name):
+                return None
+
+        resource = BeaconInfoResource({"cache_granularity_seconds": 10})
+        body = json.loads(resource.render_GET(Request()))
+        self.assertEqual(body["timestamp_granularity"], 10)
+        self.assertNotIn(
+            "timestamp_granularity",
+            json.loads(BeaconInfoResource({}).render_GET(Request())))
@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# © ECAD Infra Inc.
+#
+# Tests for the federation and login statistics and the log pipeline in
+# beacon_monitor_module.
+#
+#   python -m twisted.trial tests
+
+import logging
+from unittest import mock
+
+from prometheus_client import REGISTRY, generate_latest
+from synapse.api.errors import SynapseError
+from synapse.types import UserID, create_requester
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import beacon_monitor_module
+from beacon_monitor_module import (
+    FederationStatsResource,
+    _FederationStats,
+    _LogPipeline,
+    _LoginTracker,
+)
+
+
+class _Api:
+    """The parts of ModuleApi the admin-only resources use."""
+
+    def __init__(self, admin: bool):
+        self._admin = admin
+
+    async def get_user_by_req(self, request):
+        return create_requester(UserID("someone", "example.com"))
+
+    async def is_user_admin(self, user_id: str) -> bool:
+        return self._admin
+
+
+class FederationStatsTestCase(unittest.TestCase):
+    def test_no_servers_tracked(self):
+        stats = _FederationStats(0, 60)
+        stats.record("remote.example.com", 120)
+        self.assertEqual(len(stats), 0)
+        self.assertEqual(stats.snapshot(), [])
+
+    def test_idle_servers(self):
+        stats = _FederationStats(10, 60)
+        with mock.patch("time.time", return_value=1000.0):
+            stats.record("quiet.example.com", 120)
+        with mock.patch("time.time", return_value=1030.0):
+            stats.record("busy.example.com", 80)
+        with mock.patch("time.time", return_value=1070.0):
+            self.assertEqual(
+                [entry["server"] for entry in stats.snapshot()], ["busy.example.com"])
+            # snapshot() leaves eviction to the reactor
+            self.assertEqual(len(stats), 2)
+        stats.expire(1070)
+        self.assertEqual(len(stats), 1)
+        stats.expire(1100)
+        self.assertEqual(len(stats), 0)
+
+    @defer.inlineCallbacks
+    def test_resource_is_admin_only(self):
+        stats = _FederationStats(10, 60)
+        stats.record("remote.example.com", 120)
+        with self.assertRaises(SynapseError) as raised:
+            yield defer.ensureDeferred(
+                FederationStatsResource(_Api(False), stats)._async_render_GET(None))
+        self.assertEqual(raised.exception.code, 403)
+
+        code, body = yield defer.ensureDeferred(
+            FederationStatsResource(_Api(True), stats)._async_render_GET(None))
+        self.assertEqual(code, 200)
+        self.assertEqual(body["servers"][0]["server"], "remote.example.com")
+
+
+class LoginTrackerTestCase(unittest.TestCase):
+    def test_empty_snapshot(self):
+        snapshot = _LoginTracker(300, 100).snapshot()
+        self.assertEqual(snapshot["distinct_users"], 0)
+        self.assertEqual(snapshot["new_ratio"], 0.0)
+
+    def test_distinct_users(self):
+        tracker = _LoginTracker(300, 100)
+        for i in range(50):
+            tracker.record("@user{}:example.com".format(i % 20), "local")
+        snapshot = tracker.snapshot()
+        self.assertEqual(snapshot["distinct_users"], 20)
+        self.assertEqual(snapshot["new_ratio"], 20 / 50)
+
+    def test_scrape_with_empty_tracker(self):
+        with mock.patch.object(
+                beacon_monitor_module._login_collector, "tracker",
+                _LoginTracker(300, 100)):
+            text = generate_latest(REGISTRY).decode()
+        self.assertIn("beacon_monitor_login_distinct_users 0.0", text)
+
+
+class _Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class LogPipelineTestCase(unittest.TestCase):
+    def logger(self) -> tuple[logging.Logger, _Records]:
+        logger = logging.getLogger("tests.log_pipeline.{}".format(self.id()))
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        records = _Records()
+        logger.addHandler(records)
+        return logger, records
+
+    def test_writer_starts_with_the_reactor(self):
+        logger, records = self.logger()
+        with mock.patch.object(beacon_monitor_module.reactor, "callWhenRunning") as when:
+            pipeline = _LogPipeline(logger, 10, "oldest", 0.01)
+        when.assert_called_once_with(pipeline._thread.start)
+        self.assertFalse(pipeline._thread.is_alive())
+
+        # Stopped before the reactor ran: what was queued is written inline
+        pipeline.log(logging.INFO, "event=%s", "QUEUED")
+        pipeline.stop()
+        self.assertEqual(records.messages, ["event=QUEUED"])
+
+    def test_writer_flushes_on_stop(self):
+        logger, records = self.logger()
+        pipeline = _LogPipeline(logger, 10, "oldest", 0.01)
+        for i in range(3):
+            pipeline.log(logging.INFO, "event=LINE n=%d", i)
+        pipeline.stop()
+        self.assertEqual(
+            records.messages, ["event=LINE n={}".format(i) for i in range(3)])
@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# © ECAD Infra Inc.
+#
+# Tests for crypto_auth_provider's login path, with a stand-in account
+# handler that follows Synapse's logcontext rules.
+#
+#   python -m twisted.trial tests
+
+import time
+from unittest import mock
+
+import nacl.encoding
+import nacl.hash
+import nacl.signing
+from synapse.logging.context import (
+    SENTINEL_CONTEXT,
+    LoggingContext,
+    current_context,
+    make_deferred_yieldable,
+)
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+import crypto_auth_provider
+from crypto_auth_provider import WINDOW_SECONDS, CryptoAuthProvider, _ChallengeDigests
+
+
+def _credentials(signing_key, window: int | None = None) -> tuple[str, str]:
+    if window is None:
+        window = int(time.time() / WINDOW_SECONDS)
+    public_key = signing_key.verify_key.encode()
+    digest = nacl.hash.blake2b(
+        "login:{}".format(window).encode(),
+        digest_size=32, encoder=nacl.encoding.RawEncoder)
+    signature = signing_key.sign(digest).signature
+    localpart = nacl.hash.blake2b(
+        public_key, digest_size=32, encoder=nacl.encoding.RawEncoder).hex()
+    return (
+        "@{}:example.com".format(localpart),
+        "ed:{}:{}".format(signature.hex(), public_key.hex()))
+
+
+class _AccountHandler:
+    """Answers after a short delay, like a database round-trip."""
+
+    def __init__(self):
+        self.users = set()
+        self.register_calls = 0
+
+    def _later(self, func):
+        return make_deferred_yieldable(task.deferLater(reactor, 0.02, func))
+
+    def check_user_exists(self, user_id):
+        return self._later(lambda: user_id if user_id in self.users else None)
+
+    def register(self, localpart):
+        self.register_calls += 1
+        user_id = "@{}:example.com".format(localpart)
+        self.users.add(user_id)
+        return self._later(lambda: user_id)
+
+
+class ConcurrentRegistrationTestCase(unittest.TestCase):
+    def provider(self, config) -> CryptoAuthProvider:
+        provider = CryptoAuthProvider(config, _AccountHandler())
+        self.addCleanup(provider.challenge_digests.stop)
+        if provider.verify_pool is not None:
+            self.addCleanup(provider.verify_pool._pool.stop)
+        return provider
+
+    @defer.inlineCallbacks
+    def _check_logcontexts(self, config):
+        provider = self.provider(config)
+        credentials = _credentials(nacl.signing.SigningKey.generate())
+
+        async def login(name):
+            with LoggingContext(name=name, server_name="test") as context:
+                ok = await provider.check_password(*credentials)
+                self.assertIs(current_context(), context)
+            return ok
+
+        results = yield defer.gatherResults(
+            [defer.ensureDeferred(login("req{}".format(i))) for i in range(2)])
+        self.assertEqual(results, [True, True])
+        self.assertEqual(provider.account_handler.register_calls, 1)
+        self.assertIs(current_context(), SENTINEL_CONTEXT)
+
+    def test_inline(self):
+        return self._check_logcontexts({})
+
+    def test_thread(self):
+        return self._check_logcontexts({"verify_in_thread": True})
+
+    def test_batch(self):
+        return self._check_logcontexts({"batch_verify": True})
+
+
+class ZeroTTLTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_zero_ttl_disables_failure_caches(self):
+        provider = CryptoAuthProvider({
+            "failed_cache_ttl": 0,
+            "pubkey_failure_threshold": 1,
+            "pubkey_failure_window": 0,
+        }, _AccountHandler())
+        self.addCleanup(provider.challenge_digests.stop)
+        key = nacl.signing.SigningKey.generate()
+        stale = _credentials(key, window=1)
+        for _ in range(2):
+            ok = yield provider.check_password(*stale)
+            self.assertIs(ok, False)
+        self.assertEqual(len(provider.failed_cache), 0)
+        self.assertEqual(len(provider.pubkey_failures), 0)
+        # The key is not locked out
+        ok = yield provider.check_password(*_credentials(key))
+        self.assertIs(ok, True)
+
+
+class ChallengeDigestsTestCase(unittest.TestCase):
+    def test_rotated_by_timer(self):
+        digests = _ChallengeDigests()
+        self.addCleanup(digests.stop)
+        window = int(time.time() / WINDOW_SECONDS)
+        timer = digests._timer
+        self.assertTrue(timer.active())
+        # Due at the next window boundary
+        due = timer.getTime() - crypto_auth_provider.reactor.seconds() + time.time()
+        self.assertLess(abs(due - (window + 1) * WINDOW_SECONDS), 1)
+
+        # Logins find the table ready and hash nothing
+        with mock.patch.object(
+                crypto_auth_provider, "_challenge_digest",
+                side_effect=AssertionError("hashed during a login")):
+            table = digests.get(window)
+        self.assertEqual(sorted(table), list(range(window - 1, window + 3)))
+        self.assertEqual(
+            table[window], crypto_auth_provider._challenge_digest(window))